@@ -0,0 +1,275 @@
+"""
+aisensy_client.py
+Shared AiSensy HTTP client used by app.py, relay.py and send_test_whatsapp.py.
+
+One pooled keep-alive requests.Session per process, so messages reuse TCP+TLS
+connections instead of handshaking every time. Every attempt first takes a
+token from a rate limiter, is retried with jittered backoff only when AiSensy
+cannot have acted on it (no connection established, 429, 503), and goes through a
+circuit breaker that fails fast while the upstream error rate is too high.
+The ``timeout`` given to send() bounds the whole call, retries included, so it
+stays inside the caller's request budget (gunicorn kills workers after 30s).
+
+Configuration (environment):
+  AISENSY_API_URL, AISENSY_API_KEY
+  AISENSY_POOL_SIZE          keep-alive connections per process (default 10)
+  AISENSY_RATE_PER_SEC       sustained request rate (default 10)
+  AISENSY_BURST              short burst allowance (default 20)
+  AISENSY_MAX_RETRIES        extra attempts for retryable failures (default 3)
+  AISENSY_BREAKER_THRESHOLD  error rate that opens the breaker (default 0.5)
+  AISENSY_BREAKER_MIN_CALLS  calls in the window before it can open (default 20)
+  AISENSY_BREAKER_WINDOW     seconds of history considered (default 30)
+  AISENSY_BREAKER_COOLDOWN   seconds before a trial call is let through (default 30)
+"""
+import collections
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import metrics
+
+DEFAULT_API_URL = 'https://api.aisensy.com/v1/message'
+
+# Statuses where AiSensy rejected the request without acting on it.
+RETRY_STATUSES = (429, 503)
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of calling AiSensy while the circuit breaker is open."""
+
+
+class RateLimitTimeout(requests.exceptions.RequestException):
+    """Raised when no rate-limit token became available in time."""
+
+
+def is_unsent(exc):
+    """True when ``exc`` means the request never reached AiSensy.
+
+    Only then is a resend safe. A connection dropped after the body was
+    written ("Connection aborted") or a read timeout may already have been
+    acted on, so it is not.
+    """
+    if isinstance(exc, (CircuitOpenError, RateLimitTimeout, requests.exceptions.ConnectTimeout)):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError) and exc.args:
+        return isinstance(getattr(exc.args[0], 'reason', None), NewConnectionError)
+    return False
+
+
+class TokenBucket:
+    """Thread-safe token bucket: ``rate`` tokens/second, holding at most ``capacity``."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """Block until a token is available; False if ``timeout`` elapses first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Error-rate circuit breaker over a sliding time window.
+
+    Closed: calls pass and outcomes are recorded. Once at least ``min_calls``
+    outcomes in the last ``window`` seconds have an error rate of
+    ``threshold`` or more, the breaker opens and rejects calls. After
+    ``cooldown`` seconds a single trial call is allowed (half-open); its
+    outcome closes or re-opens the breaker.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=0.5, min_calls=20, window=30.0, cooldown=30.0):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._outcomes = collections.deque()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                self._outcomes.clear()
+                if ok:
+                    self.state = self.CLOSED
+                else:
+                    self.state, self._opened_at = self.OPEN, now
+                self._trial_running = False
+                return
+            self._outcomes.append((now, ok))
+            while self._outcomes and now - self._outcomes[0][0] > self.window:
+                self._outcomes.popleft()
+            failures = sum(1 for _, good in self._outcomes if not good)
+            if (self.state == self.CLOSED and len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.threshold):
+                self.state, self._opened_at = self.OPEN, now
+
+
+class AiSensyClient:
+    def __init__(self, api_url=None, api_key=None, pool_size=None, rate_per_sec=None, burst=None,
+                 max_retries=None, backoff_base=0.5, backoff_cap=8.0, timeout=15, breaker=None):
+        env = os.environ.get
+        self.api_url = api_url or env('AISENSY_API_URL') or DEFAULT_API_URL
+        self.api_key = api_key if api_key is not None else env('AISENSY_API_KEY', '')
+        self.pool_size = int(pool_size or env('AISENSY_POOL_SIZE', 10))
+        self.max_retries = int(max_retries if max_retries is not None else env('AISENSY_MAX_RETRIES', 3))
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.limiter = TokenBucket(
+            float(rate_per_sec or env('AISENSY_RATE_PER_SEC', 10)),
+            float(burst or env('AISENSY_BURST', 20)),
+        )
+        self.breaker = breaker or CircuitBreaker(
+            threshold=float(env('AISENSY_BREAKER_THRESHOLD', 0.5)),
+            min_calls=int(env('AISENSY_BREAKER_MIN_CALLS', 20)),
+            window=float(env('AISENSY_BREAKER_WINDOW', 30)),
+            cooldown=float(env('AISENSY_BREAKER_COOLDOWN', 30)),
+        )
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json',
+        })
+
+    def _backoff(self, attempt, resp=None):
+        """Full-jitter exponential backoff, honouring Retry-After when given."""
+        if resp is not None:
+            retry_after = resp.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), self.backoff_cap)
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def _post(self, payload, timeout):
+        """One timed HTTP attempt."""
+        metrics.UPSTREAM_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            resp = self.session.post(self.api_url, json=payload, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            metrics.UPSTREAM_LATENCY.labels('error').observe(time.perf_counter() - started)
+            metrics.UPSTREAM_RESPONSES.labels(type(e).__name__).inc()
+            raise
+        finally:
+            metrics.UPSTREAM_IN_FLIGHT.dec()
+        outcome = 'ok' if resp.status_code < 400 else 'http_error'
+        metrics.UPSTREAM_LATENCY.labels(outcome).observe(time.perf_counter() - started)
+        metrics.UPSTREAM_RESPONSES.labels(str(resp.status_code)).inc()
+        return resp
+
+    def send(self, payload, timeout=None):
+        """POST a message payload to AiSensy and return the final Response.
+
+        ``timeout`` is the budget for the whole call: rate-limit waits, every
+        attempt and the backoff between them. A retry that would not fit is
+        not made; the last response (or error) is returned instead.
+
+        Raises requests.RequestException (including CircuitOpenError and
+        RateLimitTimeout) when no response could be obtained.
+        """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            # Take the token before asking the breaker, so a half-open trial
+            # is never claimed by a call that then gives up waiting here.
+            if not self.limiter.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                metrics.UPSTREAM_RESPONSES.labels('rate_limit_timeout').inc()
+                raise RateLimitTimeout('Timed out waiting for an AiSensy rate-limit token')
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RateLimitTimeout('AiSensy send deadline exceeded before sending')
+            if not self.breaker.allow():
+                metrics.UPSTREAM_RESPONSES.labels('circuit_open').inc()
+                raise CircuitOpenError('AiSensy circuit breaker is open; not sending')
+            try:
+                resp = self._post(payload, remaining)
+            except Exception as e:
+                # Any outcome must reach the breaker, or a half-open trial
+                # would never be released.
+                self.breaker.record(False)
+                # Only failures to connect are retried. Read timeouts and
+                # connections dropped mid-request are not: AiSensy may have
+                # sent the message already.
+                if not is_unsent(e):
+                    raise
+                delay = self._backoff(attempt)
+                if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            self.breaker.record(resp.status_code < 500 and resp.status_code != 429)
+            if resp.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                delay = self._backoff(attempt, resp)
+                if time.monotonic() + delay < deadline:
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+            return resp
+
+    def send_text(self, to, body, timeout=None):
+        return self.send({'to': to, 'type': 'text', 'text': {'body': body}}, timeout=timeout)
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide client, creating it after fork if needed."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = AiSensyClient()
+                _client_pid = os.getpid()
+    return _client
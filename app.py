@@ -1,7 +1,25 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+import base64
+import csv
+import hashlib
+import io
+import json
+import math
 import os
+import click
 import requests
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from urllib.parse import urlsplit
+
+import db_config
+import geocoding
+import metrics
+import migrate
+from aisensy_client import get_client
+from pairings import PairingStore
+from ttl_cache import LRUTTLCache
 
 # --- Flask setup ---
 app = Flask(__name__)
@@ -9,22 +27,407 @@ app = Flask(__name__)
 # Secret key
 app.secret_key = os.getenv('SECRET_KEY', 'fallback_secret')
 
-# Database setup
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
+# Admin dashboard password (login form or ?password= on admin links)
+ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', '')
+
+# Database setup (DATABASE_URL, pool and SQLite WAL settings: see db_config.py)
+db_config.configure_app(app)
 db = SQLAlchemy(app)
 
-# --- Database Model Example ---
+# --- Database Models (canonical schema) ---
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(80), nullable=False)
-    phone = db.Column(db.String(20), nullable=False)
-    pickup = db.Column(db.String(120), nullable=False)
-    destination = db.Column(db.String(120), nullable=False)
+    name = db.Column(db.String(100), nullable=False, index=True)
+    phone = db.Column(db.String(50), nullable=False, index=True)
+    latitude = db.Column(db.Float, nullable=False, index=True)
+    longitude = db.Column(db.Float, nullable=False, index=True)
+    matched_with = db.Column(db.String(200))
+    pickup = db.Column(db.String(120))
+    destination = db.Column(db.String(120))
+
+# --- Precomputed pairings (one row per pair, lower user id first) ---
+class Pairing(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    partner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
+    distance_km = db.Column(db.Float, nullable=False, index=True)
+
+# --- Shared change counters ---
+# Bumped in the same transaction as the change, so every worker can tell with
+# one primary-key read whether its in-process caches are still current.
+class DataVersion(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+USERS_VERSION = 'users'
+
+with app.app_context():
+    db_config.configure_engine(db.engine)
+    metrics.instrument_engine(db.engine, 'app')
+    db_config.upgrade_schema(db.engine, db.metadata)
+
+# Request latency, /metrics and /debug/profiler
+metrics.init_app(app, 'app')
+
+pairing_store = PairingStore(db, User, Pairing)
+
+with app.app_context():
+    if db.session.get(DataVersion, USERS_VERSION) is None:
+        try:
+            db.session.add(DataVersion(name=USERS_VERSION, value=0))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+# Existing users (e.g. right after the pairing table was added or a legacy
+# migration) get their initial pairs once; later changes are incremental.
+with app.app_context():
+    if (db.session.execute(db.select(Pairing.user_id).limit(1)).first() is None
+            and db.session.execute(db.select(User.id).limit(1)).first() is not None):
+        try:
+            app.logger.info('Pairing table is empty; rebuilt %s pairs.', pairing_store.rebuild())
+            db.session.commit()
+        except IntegrityError:
+            # Another worker booting at the same time got there first.
+            db.session.rollback()
+
+def users_version():
+    return db.session.execute(
+        db.select(DataVersion.value).where(DataVersion.name == USERS_VERSION)
+    ).scalar() or 0
+
+def bump_users_version():
+    """Mark every worker's cached user lookups stale.
+
+    Call it first in a transaction that changes users or pairings: the
+    UPDATE row-locks data_version (Postgres) or takes the write lock
+    (SQLite), so concurrent re-pairings run one at a time instead of
+    claiming the same free neighbour.
+    """
+    db.session.execute(
+        db.update(DataVersion).where(DataVersion.name == USERS_VERSION)
+        .values(value=DataVersion.value + 1)
+    )
+
+# /get_user answers, keyed by name and tagged with the users version they
+# were read at; an entry from an older version is treated as a miss
+user_lookup_cache = LRUTTLCache(
+    maxsize=int(os.getenv('GET_USER_CACHE_SIZE', 4096)),
+    ttl=float(os.getenv('GET_USER_CACHE_TTL', 30)),
+)
+
+# Pickup/destination coordinates and map-point labels (see geocoding.py).
+# Request handlers only read the cache; misses are resolved in the background.
+geocoder = geocoding.from_env(app.instance_path)
+geocode_warmer = geocoding.Warmer(geocoder)
+
+def safe_next_url(next_url):
+    """Return ``next_url`` only if it is a path on this site (no //host or /\\host)."""
+    next_url = (next_url or '').replace('\\', '/')
+    if any(ord(ch) < 32 for ch in next_url):  # browsers drop tabs/newlines: "/\t/host"
+        return None
+    parts = urlsplit(next_url)
+    if not next_url.startswith('/') or next_url.startswith('//') or parts.scheme or parts.netloc:
+        return None
+    return next_url
+
+def is_admin():
+    if not ADMIN_PASSWORD:
+        return False
+    return session.get('admin') or request.args.get('password') == ADMIN_PASSWORD
 
 # --- Home Route ---
 @app.route('/')
 def index():
-    return "Flask app running! Use /echo to test or /relay to send WhatsApp messages."
+    return render_template('index.html')
+
+@app.route('/thank_you')
+def thank_you():
+    return render_template('thank_you.html')
+
+# --- Registration form ---
+@app.route('/get_user/<name>')
+def get_user(name):
+    """
+    Looks up a user by name to pre-fill the form (called on every blur).
+    Answers come from a per-process LRU+TTL cache, validated against the
+    shared users version (one primary-key read), and carry an ETag, so a
+    repeat lookup with If-None-Match returns 304 without the user query.
+    Any submit or delete, in any worker, invalidates every cached answer.
+    """
+    key = name.strip()
+    # Read the version first: an answer read after it can only be newer.
+    version = users_version()
+    entry = user_lookup_cache.get(key)
+    if entry is None or entry[2] != version:
+        user = db.session.execute(
+            db.select(User).filter_by(name=key).limit(1)
+        ).scalar_one_or_none()
+        data = None if user is None else {
+            "name": user.name,
+            "phone": user.phone,
+            "latitude": user.latitude,
+            "longitude": user.longitude,
+        }
+        body = app.json.dumps(data)
+        entry = (body, hashlib.sha1(body.encode()).hexdigest(), version)
+        user_lookup_cache.set(key, entry)
+
+    body, etag, _ = entry
+    headers = {'Cache-Control': 'private, no-cache'}
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304, headers=headers)
+    else:
+        resp = Response(body, mimetype='application/json', headers=headers)
+    resp.set_etag(etag)
+    return resp
+
+@app.route('/submit', methods=['POST'])
+def submit():
+    """
+    Creates or updates (by name) a user from the index.html form and
+    re-pairs only the users affected by the change. Optional free-text
+    "pickup" and "destination" are stored and geocoded in the background.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "error": "invalid request body"}), 400
+    name = (data.get('name') or '').strip()
+    phone = (data.get('phone') or '').strip()
+    pickup = str(data.get('pickup') or '').strip()[:120] or None
+    destination = str(data.get('destination') or '').strip()[:120] or None
+    location = data.get('location') or {}
+    try:
+        lat = float(location['lat'])
+        lng = float(location['lng'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"status": "error", "error": "invalid location"}), 400
+    # inf/nan would break pairing (math.cos) and the admin JSON
+    if not (math.isfinite(lat) and math.isfinite(lng) and -90 <= lat <= 90 and -180 <= lng <= 180):
+        return jsonify({"status": "error", "error": "invalid location"}), 400
+    if not name or not phone:
+        return jsonify({"status": "error", "error": "missing name or phone"}), 400
+
+    bump_users_version()
+    user = db.session.execute(
+        db.select(User).filter_by(name=name).limit(1)
+    ).scalar_one_or_none()
+    if user is None:
+        user = User(name=name, phone=phone, latitude=lat, longitude=lng,
+                    pickup=pickup, destination=destination)
+        db.session.add(user)
+    else:
+        user.phone, user.latitude, user.longitude = phone, lat, lng
+        user.pickup = pickup or user.pickup
+        user.destination = destination or user.destination
+    pairing_store.add(user)
+    db.session.commit()
+    geocode_warmer.submit(addresses=[pickup, destination], points=[(lat, lng)])
+    return jsonify({"status": "success", "redirect": url_for('thank_you')})
+
+# --- Admin dashboard ---
+@app.route('/admin', methods=['GET', 'POST'])
+def admin():
+    if request.method == 'POST':
+        if ADMIN_PASSWORD and request.form.get('password') == ADMIN_PASSWORD:
+            session['admin'] = True
+            return redirect(safe_next_url(request.form.get('next')) or url_for('admin'))
+        return render_template('admin_login.html', error=True), 401
+    if not is_admin():
+        return render_template('admin_login.html')
+
+    user_count = db.session.execute(db.select(db.func.count(User.id))).scalar()
+    return render_template('admin.html', user_count=user_count, pairings=pairing_store.pairings())
+
+# --- Admin user table API ---
+ADMIN_SORT_COLUMNS = {
+    'id': User.id,
+    'name': User.name,
+    'phone': User.phone,
+    'latitude': User.latitude,
+    'longitude': User.longitude,
+}
+ADMIN_PAGE_MAX = 200
+
+def encode_cursor(value, user_id):
+    raw = json.dumps([value, user_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor):
+    value, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return value, int(user_id)
+
+def filtered_users(query):
+    """Apply the admin name/phone prefix filters from the query string.
+
+    Prefixes are matched as ranges (col >= p AND col < p + U+FFFF) so they use
+    the name/phone indexes; LIKE would not, as it is case-insensitive in SQLite.
+    """
+    for column, value in ((User.name, request.args.get('q', '')), (User.phone, request.args.get('phone', ''))):
+        value = value.strip()
+        if value:
+            query = query.where(column >= value, column < value + '\uffff')
+    return query
+
+@app.route('/admin/api/users')
+def admin_users_api():
+    """
+    One page of the admin user table, keyset-paginated.
+    Query: sort=id|name|phone|latitude|longitude, dir=asc|desc, q=<name prefix>,
+    phone=<phone prefix>, limit=<n>, after=<cursor from the previous page>.
+    """
+    if not is_admin():
+        return jsonify({"error": "unauthorized"}), 401
+
+    sort = request.args.get('sort', 'id')
+    column = ADMIN_SORT_COLUMNS.get(sort)
+    if column is None:
+        return jsonify({"error": "invalid sort column"}), 400
+    descending = request.args.get('dir', 'asc') == 'desc'
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), ADMIN_PAGE_MAX))
+    except ValueError:
+        return jsonify({"error": "invalid limit"}), 400
+
+    query = filtered_users(db.select(User))
+    after = request.args.get('after')
+    if after:
+        try:
+            value, last_id = decode_cursor(after)
+        except (ValueError, TypeError):
+            return jsonify({"error": "invalid cursor"}), 400
+        if descending:
+            query = query.where(or_(column < value, and_(column == value, User.id < last_id)))
+        else:
+            query = query.where(or_(column > value, and_(column == value, User.id > last_id)))
+    if descending:
+        query = query.order_by(column.desc(), User.id.desc())
+    else:
+        query = query.order_by(column.asc(), User.id.asc())
+
+    # Fetch one extra row to know whether another page exists.
+    rows = db.session.execute(query.limit(limit + 1)).scalars().all()
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        last = page[-1]
+        next_cursor = encode_cursor(getattr(last, sort), last.id)
+
+    # Location labels and address coordinates come from the geocode cache
+    # only; anything not cached yet is resolved in the background.
+    points = [(u.latitude, u.longitude) for u in page]
+    addresses = [a for u in page for a in (u.pickup, u.destination) if a]
+    labels = geocoder.reverse_many(points, cached_only=True)
+    places = geocoder.geocode_many(addresses, cached_only=True)
+    # (Cached "not found" answers also come back as None; the warmer finds
+    # them in the cache and does not query the provider again.)
+    geocode_warmer.submit(addresses=[a for a in addresses if places.get(a) is None],
+                          points=[p for p in points if labels.get(p) is None])
+
+    def label_of(user):
+        place = labels.get((user.latitude, user.longitude))
+        return None if place is None else place.label
+
+    def place_json(address):
+        place = places.get(address)
+        return None if place is None else {"latitude": place.latitude, "longitude": place.longitude}
+
+    return jsonify({
+        "users": [{
+            "id": u.id,
+            "name": u.name,
+            "phone": u.phone,
+            "latitude": u.latitude,
+            "longitude": u.longitude,
+            "location_label": label_of(u),
+            "pickup": u.pickup,
+            "pickup_location": place_json(u.pickup),
+            "destination": u.destination,
+            "destination_location": place_json(u.destination),
+        } for u in page],
+        "next": next_cursor,
+    })
+
+@app.route('/admin/export.csv')
+def admin_export_csv():
+    """Streams every user (honouring q/phone filters) as CSV, in batches."""
+    if not is_admin():
+        return redirect(url_for('admin', next=request.full_path))
+    query = filtered_users(
+        db.select(User.id, User.name, User.phone, User.latitude, User.longitude).order_by(User.id)
+    ).execution_options(yield_per=1000)
+
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        # BOM so spreadsheet apps detect UTF-8 (Arabic names)
+        buf.write('\ufeff')
+        writer.writerow(['id', 'name', 'phone', 'latitude', 'longitude'])
+        for partition in db.session.execute(query).partitions():
+            writer.writerows(partition)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv', headers={
+        'Content-Disposition': 'attachment; filename=users.csv',
+    })
+
+@app.route('/admin_logout')
+def admin_logout():
+    session.pop('admin', None)
+    return redirect(url_for('admin'))
+
+@app.route('/delete/<int:user_id>')
+def delete_user(user_id):
+    if not is_admin():
+        return redirect(url_for('admin', next=request.path))
+    bump_users_version()
+    user = db.session.get(User, user_id)
+    if user is not None:
+        pairing_store.remove(user)
+        db.session.commit()
+    return redirect(url_for('admin'))
+
+# --- Pairing maintenance commands ---
+@app.cli.command('rebuild-pairings')
+def rebuild_pairings_command():
+    """Recompute every stored pairing from scratch."""
+    bump_users_version()
+    count = pairing_store.rebuild()
+    db.session.commit()
+    click.echo(f'Rebuilt {count} pairs.')
+
+@app.cli.command('check-pairings')
+def check_pairings_command():
+    """Compare stored pairings with a from-scratch computation."""
+    problems = pairing_store.check()
+    for problem in problems:
+        click.echo(problem)
+    if problems:
+        raise SystemExit(1)
+    click.echo('Stored pairings are consistent.')
+
+# --- Geocoding ---
+@app.cli.command('geocode-users')
+@click.option('--batch-size', default=100, show_default=True, help='Users resolved per batch.')
+def geocode_users_command(batch_size):
+    """Fill the geocode cache for every user's map point and addresses.
+
+    Cached answers are reused, so re-running only queries new or expired
+    entries; expired cache rows are purged first.
+    """
+    if geocoder.provider is None:
+        raise SystemExit('Geocoding is off (set GEOCODER=nominatim or GEOCODER=stub).')
+    click.echo(f'Purged {geocoder.cache.purge_expired()} expired cache entries.')
+    query = db.select(User.latitude, User.longitude, User.pickup, User.destination).order_by(User.id)
+    labelled = located = 0
+    for partition in db.session.execute(query.execution_options(yield_per=batch_size)).partitions():
+        labels = geocoder.reverse_many([(lat, lng) for lat, lng, _, _ in partition])
+        places = geocoder.geocode_many([a for row in partition for a in row[2:] if a])
+        labelled += sum(1 for place in labels.values() if place is not None)
+        located += sum(1 for place in places.values() if place is not None)
+    click.echo(f'{labelled} point labels and {located} addresses resolved.')
 
 # --- ECHO Test Route ---
 @app.route('/echo', methods=['POST'])
@@ -64,13 +467,9 @@ def relay_message():
         return jsonify({"error": "Missing AiSensy configuration"}), 500
 
     data = request.get_json(force=True, silent=True) or {}
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
 
     try:
-        resp = requests.post(api_url, headers=headers, json=data, timeout=10)
+        resp = get_client().send(data, timeout=10)
         return jsonify({
             "status_code": resp.status_code,
             "response": resp.text
@@ -78,6 +477,27 @@ def relay_message():
     except requests.exceptions.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
+# --- Legacy database migration ---
+@app.cli.command('migrate-legacy')
+@click.argument('sources', nargs=-1, type=click.Path())
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per insert transaction.')
+def migrate_legacy_command(sources, batch_size):
+    """Copy users from the legacy SQLite files into the current database.
+
+    Defaults to users.db, instance/users.db and instance/local.db; duplicates
+    (by phone) are skipped and pairings are rebuilt afterwards.
+    """
+    sources = sources or (
+        os.path.join(app.root_path, 'users.db'),
+        os.path.join(app.instance_path, 'users.db'),
+        os.path.join(app.instance_path, 'local.db'),
+    )
+    migrate.migrate_sqlite_files(db.engine, User.__table__, sources, batch_size=batch_size, log=click.echo)
+    bump_users_version()
+    count = pairing_store.rebuild()
+    db.session.commit()
+    click.echo(f'Rebuilt {count} pairs.')
+
 # --- Run the app ---
 if __name__ == '__main__':
     port = int(os.getenv("PORT", 5000))
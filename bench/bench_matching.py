@@ -0,0 +1,89 @@
+"""
+bench_matching.py
+Benchmark for the admin pairing engine in matching.py.
+
+Generates synthetic users scattered around Jeddah and times index build plus
+greedy pairing at several scales. With --check, results at small scales are
+compared against a brute-force all-pairs implementation.
+
+Usage:
+  python3 bench/bench_matching.py
+  python3 bench/bench_matching.py --sizes 1000 10000 100000 --max-km 3 --check
+"""
+import argparse
+import os
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import matching  # noqa: E402
+
+FakeUser = namedtuple('FakeUser', 'name phone latitude longitude')
+
+# Roughly the Jeddah metro area around the default map centre in index.html.
+CENTER = (21.2854, 39.2376)
+SPREAD_DEG = 0.35
+
+
+def synthetic_users(n, seed=0):
+    rng = np.random.default_rng(seed)
+    lat = CENTER[0] + rng.uniform(-SPREAD_DEG, SPREAD_DEG, n)
+    lon = CENTER[1] + rng.uniform(-SPREAD_DEG, SPREAD_DEG, n)
+    return [
+        FakeUser(f'user{i}', f'05{i:08d}', float(a), float(b))
+        for i, (a, b) in enumerate(zip(lat, lon))
+    ]
+
+
+def brute_force_pairs(users, max_km):
+    """Reference O(n^2) closest-first pairing with the same tie-breaking."""
+    lat = np.array([u.latitude for u in users])
+    lon = np.array([u.longitude for u in users])
+    i, j = np.triu_indices(len(users), k=1)
+    d = matching.haversine_km(lat[i], lon[i], lat[j], lon[j])
+    keep = d <= max_km
+    i, j, d = i[keep], j[keep], d[keep]
+    taken = set()
+    pairs = []
+    order = np.lexsort((j, i, d))
+    for a, b, km in zip(i[order].tolist(), j[order].tolist(), np.round(d[order], 2).tolist()):
+        if a in taken or b in taken:
+            continue
+        taken.update((a, b))
+        pairs.append((users[a].name, users[a].phone, users[b].name, users[b].phone, km))
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--max-km', type=float, default=matching.DEFAULT_MAX_KM)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--check', action='store_true',
+                        help='compare against brute force for sizes <= 3000')
+    args = parser.parse_args()
+
+    print(f'max_km={args.max_km}')
+    print(f'{"users":>8} {"pairs":>8} {"best s":>8} {"mean s":>8}')
+    for n in args.sizes:
+        users = synthetic_users(n)
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            pairs = matching.compute_pairings(users, args.max_km)
+            timings.append(time.perf_counter() - start)
+        print(f'{n:>8} {len(pairs):>8} {min(timings):>8.3f} {sum(timings) / len(timings):>8.3f}')
+        if args.check and n <= 3000:
+            expected = brute_force_pairs(users, args.max_km)
+            status = 'ok' if expected == pairs else 'MISMATCH'
+            print(f'{"":>8} brute-force check: {status}')
+            if status != 'ok':
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+"""
+loadtest.py
+Load test for app:app and relay:app under gunicorn, against a local AiSensy stub.
+
+For every worker class and worker count, a gunicorn server is started on a
+scratch database, driven by a pool of keep-alive client threads for a fixed
+duration, and measured: throughput, p50/p95/p99 latency, status codes and the
+resident memory of the gunicorn master plus workers. AiSensy is replaced by
+bench/stub_aisensy.py, so the relay numbers reflect the configured upstream
+latency, error rate and 429 throttling instead of the real API.
+
+Targets:
+  relay        POST /relay on relay:app (synchronous forwarding to the stub)
+  relay-async  POST /relay on relay:app with RELAY_ASYNC=1 (queued, 202)
+  echo         POST /echo on app:app (framework overhead only)
+  get_user     GET /get_user/<name> on app:app, for each --scales user count
+  pairing      admin pairing compute/rebuild/read in-process, for each scale
+
+Results are written as JSON; --compare prints the change against an earlier
+results file and exits 1 when throughput or p95 regressed past --tolerance.
+
+Usage:
+  python3 bench/loadtest.py
+  python3 bench/loadtest.py --targets relay get_user --workers 2 4 --worker-classes sync gevent
+  python3 bench/loadtest.py --stub-latency-ms 300 --stub-throttle-rps 50 --compare bench/results/base.json
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_matching import synthetic_users  # noqa: E402
+
+SERVER_TARGETS = ('relay', 'relay-async', 'echo', 'get_user')
+ALL_TARGETS = SERVER_TARGETS + ('pairing',)
+DEFAULT_TARGETS = ('relay', 'echo', 'get_user', 'pairing')
+
+MESSAGE = {'to': '+966500000000', 'type': 'text', 'text': {'body': 'load test'}}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=30.0, proc=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f'process exited with {proc.returncode} before {url} came up')
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} did not come up within {timeout:.0f}s')
+
+
+def stop(proc, timeout=15.0):
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def process_tree_rss_mb(pid):
+    """Resident memory of ``pid`` and all its descendants, from /proc (Linux)."""
+    def children(p):
+        found = []
+        try:
+            for task in os.listdir(f'/proc/{p}/task'):
+                with open(f'/proc/{p}/task/{task}/children') as f:
+                    found += [int(c) for c in f.read().split()]
+        except OSError:
+            pass
+        return found
+
+    total_kb, stack, seen = 0, [pid], set()
+    while stack:
+        p = stack.pop()
+        if p in seen:
+            continue
+        seen.add(p)
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            if p == pid:
+                return None
+        stack += children(p)
+    return round(total_kb / 1024, 1)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    # nearest-rank
+    k = min(len(sorted_values) - 1, max(0, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+# --- Load generation ---
+def make_request(target, scale):
+    """Return (method, path, json_body) for one request against ``target``."""
+    if target in ('relay', 'relay-async'):
+        return 'POST', '/relay', MESSAGE
+    if target == 'echo':
+        return 'POST', '/echo', {'hello': 'world', 'n': random.randint(0, 1000)}
+    return 'GET', f'/get_user/user{random.randrange(scale)}', None
+
+
+def drive(base_url, target, scale, concurrency, duration, warmup):
+    """Hammer ``base_url`` from ``concurrency`` threads for warmup + duration seconds.
+
+    Only requests that complete inside the measured window count, so a
+    backlog built up during warm-up does not inflate or deflate the numbers.
+    """
+    measure_from = time.monotonic() + warmup
+    deadline = measure_from + duration
+    latencies, statuses, lock = [], {}, threading.Lock()
+
+    def client():
+        session = requests.Session()
+        mine, codes = [], {}
+        while time.monotonic() < deadline:
+            method, path, body = make_request(target, scale)
+            sent = time.monotonic()
+            try:
+                code = str(session.request(method, base_url + path, json=body, timeout=60).status_code)
+            except requests.exceptions.RequestException as e:
+                code = type(e).__name__
+            done = time.monotonic()
+            if measure_from <= done <= deadline:
+                mine.append(done - sent)
+                codes[code] = codes.get(code, 0) + 1
+        with lock:
+            latencies.extend(mine)
+            for code, count in codes.items():
+                statuses[code] = statuses.get(code, 0) + count
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, statuses, duration
+
+
+def summarize(latencies, statuses, elapsed):
+    latencies.sort()
+    ms = [x * 1000 for x in latencies]
+    ok = sum(n for code, n in statuses.items() if code.isdigit() and int(code) < 400)
+    return {
+        'requests': len(latencies),
+        'ok': ok,
+        'errors': len(latencies) - ok,
+        'statuses': statuses,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        'p50_ms': round(percentile(ms, 50), 2) if ms else None,
+        'p95_ms': round(percentile(ms, 95), 2) if ms else None,
+        'p99_ms': round(percentile(ms, 99), 2) if ms else None,
+        'max_ms': round(ms[-1], 2) if ms else None,
+    }
+
+
+# --- Servers ---
+def gunicorn_command(module, port, worker_class, workers, threads):
+    cmd = [sys.executable, '-m', 'gunicorn', module, '-b', f'127.0.0.1:{port}',
+           '-w', str(workers), '-k', worker_class, '--timeout', '120']
+    if worker_class == 'gthread':
+        cmd += ['--threads', str(threads)]
+    return cmd
+
+
+def server_env(args, workdir, stub_url, database_url, target):
+    env = dict(os.environ)
+    for key in ('RELAY_SECRET', 'RELAY_ASYNC'):
+        env.pop(key, None)
+    env.update({
+        'AISENSY_API_URL': stub_url,
+        'AISENSY_API_KEY': 'loadtest',
+        'AISENSY_RATE_PER_SEC': str(args.client_rate),
+        'AISENSY_BURST': str(args.client_rate),
+        'DATABASE_URL': database_url,
+        'RELAY_QUEUE_PATH': os.path.join(workdir, 'relay_queue.db'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(workdir, 'prometheus'),
+        'SLOW_REQUEST_MS': '600000',
+        'PYTHONUNBUFFERED': '1',
+    })
+    if target == 'relay-async':
+        env['RELAY_ASYNC'] = '1'
+    return env
+
+
+def stub_counters(stub_base):
+    try:
+        return requests.get(stub_base, timeout=5).json()
+    except (requests.exceptions.RequestException, ValueError):
+        return {}
+
+
+def run_server(args, workdir, stub_url, target, scale, database_url, worker_class, workers):
+    module = 'relay:app' if target.startswith('relay') else 'app:app'
+    port = free_port()
+    log_path = os.path.join(workdir, f'gunicorn-{target}-{worker_class}-{workers}.log')
+    env = server_env(args, workdir, stub_url, database_url, target)
+    stub_base = stub_url.rsplit('/v1/', 1)[0] + '/'
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(gunicorn_command(module, port, worker_class, workers, args.threads),
+                                cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        wait_for(base_url + '/', proc=proc)
+        rss_idle = process_tree_rss_mb(proc.pid)
+        before = stub_counters(stub_base)
+        latencies, statuses, elapsed = drive(base_url, target, scale, args.concurrency,
+                                             args.duration, args.warmup)
+        after = stub_counters(stub_base)
+        rss_loaded = process_tree_rss_mb(proc.pid)
+    finally:
+        stop(proc)
+
+    result = {
+        'target': target,
+        'module': module,
+        'scale': scale,
+        'worker_class': worker_class,
+        'workers': workers,
+        'threads': args.threads if worker_class == 'gthread' else None,
+        'concurrency': args.concurrency,
+        'duration_s': round(elapsed, 2),
+    }
+    result.update(summarize(latencies, statuses, elapsed))
+    result['rss_idle_mb'] = rss_idle
+    result['rss_loaded_mb'] = rss_loaded
+    result['upstream'] = {k: after.get(k, 0) - before.get(k, 0) for k in after}
+    return result
+
+
+# --- Database seeding and the admin pairing computation ---
+def seed_database(db_path, n):
+    """Runs in a child process: fill a fresh database and time the pairing work."""
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(db_path)
+    os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    from sqlalchemy import insert
+
+    import app as webapp
+
+    with webapp.app.app_context():
+        session = webapp.db.session
+        started = time.perf_counter()
+        rows = [{'name': u.name, 'phone': u.phone, 'latitude': u.latitude, 'longitude': u.longitude}
+                for u in synthetic_users(n)]
+        for i in range(0, len(rows), 10000):
+            session.execute(insert(webapp.User), rows[i:i + 10000])
+        session.commit()
+        seed_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        webapp.pairing_store.compute()
+        compute_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        pairs = webapp.pairing_store.rebuild()
+        session.commit()
+        rebuild_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        webapp.pairing_store.pairings()
+        read_s = time.perf_counter() - started
+
+    print(json.dumps({
+        'target': 'pairing',
+        'scale': n,
+        'pairs': pairs,
+        'seed_s': round(seed_s, 3),
+        'compute_s': round(compute_s, 3),
+        'rebuild_s': round(rebuild_s, 3),
+        'read_s': round(read_s, 3),
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }))
+
+
+def seed(workdir, n):
+    db_path = os.path.join(workdir, f'users-{n}.db')
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--seed', db_path, str(n)],
+                         cwd=ROOT, capture_output=True, text=True, check=True)
+    return 'sqlite:///' + db_path, json.loads(out.stdout.strip().splitlines()[-1])
+
+
+# --- Comparison ---
+def run_key(run):
+    return (run['target'], run.get('scale'), run.get('worker_class'), run.get('workers'), run.get('concurrency'))
+
+
+def compare(results, baseline_path, tolerance):
+    """Print changes against a baseline results file; True if anything regressed."""
+    with open(baseline_path) as f:
+        baseline = {run_key(r): r for r in json.load(f)['runs']}
+    regressed = False
+    print(f'\nCompared with {baseline_path} (tolerance {tolerance:.0%}):')
+    for run in results['runs']:
+        old = baseline.get(run_key(run))
+        if old is None:
+            continue
+        label = ' '.join(str(x) for x in run_key(run) if x is not None)
+        if run['target'] == 'pairing':
+            metrics = [('rebuild_s', False), ('peak_rss_mb', False)]
+        else:
+            metrics = [('throughput_rps', True), ('p95_ms', False)]
+        parts = []
+        for name, higher_is_better in metrics:
+            before, now = old.get(name), run.get(name)
+            if not before or now is None:
+                continue
+            change = (now - before) / before
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                flag, regressed = ' REGRESSION', True
+            parts.append(f'{name} {before} -> {now} ({change:+.0%}){flag}')
+        if parts:
+            print(f'  {label}: ' + '; '.join(parts))
+    return regressed
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[1])
+    parser.add_argument('--targets', nargs='+', choices=ALL_TARGETS, default=list(DEFAULT_TARGETS))
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000],
+                        help='synthetic user counts for get_user and pairing')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--worker-classes', nargs='+', default=['sync', 'gthread', 'gevent'])
+    parser.add_argument('--threads', type=int, default=4, help='threads per gthread worker')
+    parser.add_argument('--concurrency', type=int, default=32, help='client threads')
+    parser.add_argument('--duration', type=float, default=10.0, help='measured seconds per run')
+    parser.add_argument('--warmup', type=float, default=1.0, help='unmeasured seconds per run')
+    parser.add_argument('--client-rate', type=float, default=1000.0,
+                        help='AISENSY_RATE_PER_SEC/BURST given to the servers')
+    parser.add_argument('--stub-latency-ms', type=float, default=100.0)
+    parser.add_argument('--stub-jitter-ms', type=float, default=20.0)
+    parser.add_argument('--stub-error-rate', type=float, default=0.0)
+    parser.add_argument('--stub-throttle-rps', type=int, default=0)
+    parser.add_argument('--output', help='results file (default bench/results/loadtest-<time>.json)')
+    parser.add_argument('--compare', metavar='BASELINE', help='earlier results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='relative change counted as a regression by --compare')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory (logs, databases)')
+    parser.add_argument('--seed', nargs=2, metavar=('DB', 'N'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed:
+        seed_database(args.seed[0], int(args.seed[1]))
+        return
+
+    worker_classes = []
+    for worker_class in args.worker_classes:
+        if worker_class == 'gevent' and importlib.util.find_spec('gevent') is None:
+            print('Skipping gevent workers: gevent is not installed (pip install gevent).')
+            continue
+        worker_classes.append(worker_class)
+
+    workdir = tempfile.mkdtemp(prefix='arafat-loadtest-')
+    stub_port = free_port()
+    stub = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'bench', 'stub_aisensy.py'), '--port', str(stub_port),
+        '--latency-ms', str(args.stub_latency_ms), '--jitter-ms', str(args.stub_jitter_ms),
+        '--error-rate', str(args.stub_error_rate), '--throttle-rps', str(args.stub_throttle_rps),
+    ], stdout=subprocess.DEVNULL)
+    stub_url = f'http://127.0.0.1:{stub_port}/v1/message'
+
+    results = {
+        'meta': {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('seed', 'compare', 'output', 'keep')},
+        },
+        'runs': [],
+    }
+    try:
+        wait_for(stub_url.rsplit('/v1/', 1)[0] + '/', proc=stub)
+        databases = {}
+        scales = args.scales if {'get_user', 'pairing'} & set(args.targets) else []
+        for n in scales:
+            databases[n], pairing = seed(workdir, n)
+            if 'pairing' in args.targets:
+                results['runs'].append(pairing)
+                print(f'pairing  n={n:<7} compute {pairing["compute_s"]:.3f}s  rebuild {pairing["rebuild_s"]:.3f}s  '
+                      f'read {pairing["read_s"]:.3f}s  peak {pairing["peak_rss_mb"]} MB')
+        empty_db = 'sqlite:///' + os.path.join(workdir, 'empty.db')
+
+        print(f'{"target":<12} {"scale":>7} {"class":<8} {"w":>2} {"rps":>8} {"p50":>8} {"p95":>8} '
+              f'{"p99":>8} {"err":>6} {"rss MB":>8}')
+        for target in (t for t in args.targets if t in SERVER_TARGETS):
+            for n in (scales if target == 'get_user' else [None]):
+                for worker_class in worker_classes:
+                    for workers in args.workers:
+                        run = run_server(args, workdir, stub_url, target, n, databases.get(n, empty_db),
+                                         worker_class, workers)
+                        results['runs'].append(run)
+                        print(f'{target:<12} {n or "":>7} {worker_class:<8} {workers:>2} '
+                              f'{run["throughput_rps"]:>8} {run["p50_ms"] or "-":>8} {run["p95_ms"] or "-":>8} '
+                              f'{run["p99_ms"] or "-":>8} {run["errors"]:>6} {run["rss_loaded_mb"] or "-":>8}')
+    finally:
+        stop(stub)
+        if args.keep:
+            print(f'Scratch files kept in {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or os.path.join(ROOT, 'bench', 'results',
+                                         time.strftime('loadtest-%Y%m%d-%H%M%S.json'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output}')
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+stub_aisensy.py
+Local stand-in for AISENSY_API_URL, for load tests that must not reach AiSensy.
+
+Every POST is answered after a configurable latency. A fraction of requests
+fail with 500, and requests beyond a per-second budget are throttled with 429
+and a Retry-After header, like the real API under load.
+
+Usage:
+  python3 bench/stub_aisensy.py --port 8900 --latency-ms 150 --error-rate 0.02 --throttle-rps 50
+  export AISENSY_API_URL=http://127.0.0.1:8900/v1/message
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Throttle:
+    """Fixed one-second window request counter (0 = unlimited)."""
+
+    def __init__(self, rps):
+        self.rps = rps
+        self._window = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        if not self.rps:
+            return True
+        with self._lock:
+            window = int(time.monotonic())
+            if window != self._window:
+                self._window, self._count = window, 0
+            self._count += 1
+            return self._count <= self.rps
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency_ms=100.0, jitter_ms=0.0, error_rate=0.0, throttle_rps=0):
+        super().__init__(address, _Handler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle = _Throttle(throttle_rps)
+        self.stats = {'requests': 0, 'ok': 0, 'errors': 0, 'throttled': 0}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1/message'
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats['requests'] += 1
+            self.stats[key] += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    # Headers and body go out in separate writes; without TCP_NODELAY every
+    # response would stall ~40 ms on delayed ACKs.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+
+        if not server.throttle.allow():
+            server.count('throttled')
+            return self._reply(429, {'error': 'rate limit exceeded'}, {'Retry-After': '1'})
+
+        delay = server.latency_ms + random.uniform(-server.jitter_ms, server.jitter_ms)
+        time.sleep(max(delay, 0) / 1000.0)
+        if random.random() < server.error_rate:
+            server.count('errors')
+            return self._reply(500, {'error': 'stub upstream error'})
+        server.count('ok')
+        self._reply(200, {'status': 'submitted', 'id': f'stub-{random.getrandbits(48):x}'})
+
+    def do_GET(self):
+        self._reply(200, dict(self.server.stats))
+
+    def _reply(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(port=0, **options):
+    """Start a stub server in a background thread; returns the server."""
+    server = StubServer(('127.0.0.1', port), **options)
+    threading.Thread(target=server.serve_forever, name='stub-aisensy', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local AiSensy API stub.')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency-ms', type=float, default=100.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    parser.add_argument('--throttle-rps', type=int, default=0, help='answer 429 above this many requests/s (0 = off)')
+    args = parser.parse_args()
+
+    server = StubServer(('127.0.0.1', args.port), latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                        error_rate=args.error_rate, throttle_rps=args.throttle_rps)
+    print(f'Stub AiSensy listening on {server.url} (GET / for counters)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+"""
+geocoding.py
+Cached geocoding for pickup/destination addresses and map points.
+
+Addresses are resolved to coordinates and submitted map points to readable
+labels through a pluggable provider (Nominatim via geopy, or an offline stub).
+Every answer, including "not found", is stored in a SQLite cache shared by all
+worker processes, keyed by the provider and a normalized form of the address
+(or the point rounded to ~10 m), so a repeated address never reaches the
+network twice until its TTL expires.
+
+Lookups are batched: a list of addresses is deduplicated by key, answered from
+the cache with one query, and only the misses go to the provider. Provider
+calls are spaced by a scheduler slot reserved in the same SQLite file, so the
+rate limit (Nominatim allows 1 request/s) holds across gunicorn workers, not
+just per process. Request paths use ``cached_only=True`` and hand misses to a
+background ``Warmer`` instead of waiting on the network.
+
+Environment:
+  GEOCODER                off | stub | nominatim (default off; nominatim sends
+                          addresses and users' map points to OpenStreetMap)
+  GEOCODER_USER_AGENT     identifies the app to Nominatim (default arafat-app)
+  GEOCODER_DOMAIN         self-hosted Nominatim host (default the public service)
+  GEOCODER_LANGUAGE       label language (default ar)
+  GEOCODER_COUNTRY_CODES  restrict address search (default sa)
+  GEOCODE_CACHE_PATH      cache file (default <instance>/geocode_cache.db)
+  GEOCODE_TTL_DAYS        lifetime of found places (default 90)
+  GEOCODE_MISS_TTL_HOURS  lifetime of "not found" answers (default 24)
+  GEOCODE_MIN_INTERVAL    seconds between provider calls (default: provider's own)
+"""
+import collections
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+log = logging.getLogger(__name__)
+
+ADDRESS = 'address'
+POINT = 'point'
+
+# 4 decimals is ~11 m: points closer than that share a label.
+POINT_PRECISION = 4
+
+Place = collections.namedtuple('Place', 'latitude longitude label')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS places (
+    provider TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    found INTEGER NOT NULL,
+    latitude REAL,
+    longitude REAL,
+    label TEXT,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (provider, kind, key)
+);
+CREATE INDEX IF NOT EXISTS ix_places_expires ON places (expires_at);
+CREATE TABLE IF NOT EXISTS schedule (
+    provider TEXT PRIMARY KEY,
+    next_at REAL NOT NULL
+);
+"""
+
+# Alef variants and tatweel are spelling noise in Arabic addresses.
+_ARABIC_FOLD = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ـ': None})
+
+
+def normalize_address(text):
+    """Cache key for a free-text address: same place, same key."""
+    text = unicodedata.normalize('NFKC', text or '').casefold().translate(_ARABIC_FOLD)
+    text = re.sub(r'\s*([,،])\s*', ', ', text)
+    text = re.sub(r'(, )+', ', ', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip(' ,.-،')
+
+
+def point_key(latitude, longitude):
+    return f'{latitude:.{POINT_PRECISION}f},{longitude:.{POINT_PRECISION}f}'
+
+
+class GeocodingUnavailable(Exception):
+    """The provider could not answer right now (timeout, throttled, down)."""
+
+
+# --- Providers ---
+class NominatimProvider:
+    """OpenStreetMap Nominatim through geopy (1 request/s usage policy)."""
+
+    name = 'nominatim'
+    min_interval = 1.0
+
+    def __init__(self, user_agent, domain=None, language='ar', country_codes=None, timeout=10):
+        try:
+            from geopy.geocoders import Nominatim
+        except ImportError as e:
+            raise RuntimeError('GEOCODER=nominatim needs geopy (pip install geopy)') from e
+        options = {'user_agent': user_agent, 'timeout': timeout}
+        if domain:
+            options['domain'] = domain
+        self._client = Nominatim(**options)
+        self.language = language
+        self.country_codes = country_codes
+
+    def _call(self, method, *args, **kwargs):
+        from geopy.exc import GeopyError
+        try:
+            return method(*args, **kwargs)
+        except GeopyError as e:
+            raise GeocodingUnavailable(f'{type(e).__name__}: {e}') from e
+
+    def geocode(self, query):
+        location = self._call(self._client.geocode, query, exactly_one=True,
+                              language=self.language, country_codes=self.country_codes)
+        if location is None:
+            return None
+        return Place(location.latitude, location.longitude, location.address)
+
+    def reverse(self, latitude, longitude):
+        location = self._call(self._client.reverse, (latitude, longitude), exactly_one=True,
+                              language=self.language, zoom=16)
+        if location is None:
+            return None
+        return Place(latitude, longitude, location.address)
+
+
+class StubProvider:
+    """Offline, deterministic provider for development and load tests.
+
+    Addresses map to a stable point near Jeddah derived from their text;
+    points are labelled with their rounded coordinates.
+    """
+
+    name = 'stub'
+    min_interval = 0.0
+    center = (21.2854, 39.2376)
+    spread_deg = 0.35
+
+    def __init__(self):
+        self.calls = 0
+
+    def geocode(self, query):
+        self.calls += 1
+        digest = hashlib.sha1(query.encode()).digest()
+        du = int.from_bytes(digest[:4], 'big') / 2 ** 32 - 0.5
+        dv = int.from_bytes(digest[4:8], 'big') / 2 ** 32 - 0.5
+        return Place(self.center[0] + 2 * du * self.spread_deg,
+                     self.center[1] + 2 * dv * self.spread_deg, query)
+
+    def reverse(self, latitude, longitude):
+        self.calls += 1
+        return Place(latitude, longitude, f'{latitude:.4f}, {longitude:.4f}')
+
+
+# --- Cache ---
+class GeocodeCache:
+    """SQLite cache of provider answers, shared by every worker process."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        # One connection per thread, and never reuse one inherited across fork.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get_many(self, provider, kind, keys):
+        """Unexpired answers for ``keys``: {key: Place, or None when not found}."""
+        found = {}
+        keys = list(keys)
+        now = time.time()
+        conn = self._connect()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = conn.execute(
+                f"SELECT key, found, latitude, longitude, label FROM places "
+                f"WHERE provider = ? AND kind = ? AND expires_at > ? "
+                f"AND key IN ({', '.join('?' * len(chunk))})",
+                [provider, kind, now] + chunk,
+            )
+            for key, ok, lat, lng, label in rows:
+                found[key] = Place(lat, lng, label) if ok else None
+        return found
+
+    def put(self, provider, kind, key, place, ttl):
+        lat, lng, label = place if place is not None else (None, None, None)
+        self._connect().execute(
+            "INSERT OR REPLACE INTO places (provider, kind, key, found, latitude, longitude, label, expires_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (provider, kind, key, place is not None, lat, lng, label, time.time() + ttl),
+        )
+
+    def reserve(self, provider, interval):
+        """Claim the next provider call slot; returns seconds to wait for it."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT next_at FROM schedule WHERE provider = ?', (provider,)).fetchone()
+            slot = max(now, row[0] if row else now)
+            conn.execute('INSERT OR REPLACE INTO schedule (provider, next_at) VALUES (?, ?)',
+                         (provider, slot + interval))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return slot - now
+
+    def purge_expired(self):
+        """Delete expired answers; returns how many were removed."""
+        return self._connect().execute('DELETE FROM places WHERE expires_at <= ?', (time.time(),)).rowcount
+
+
+# --- Service ---
+class Geocoder:
+    def __init__(self, provider, cache, ttl=90 * 86400, miss_ttl=86400, min_interval=None):
+        self.provider = provider
+        self.cache = cache
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.min_interval = provider.min_interval if min_interval is None and provider else (min_interval or 0.0)
+        self.provider_name = provider.name if provider else 'off'
+        # Provider calls are made one at a time per process; the cache
+        # schedule spaces them across processes.
+        self._lock = threading.Lock()
+
+    def _resolve(self, kind, keys, fetch, cached_only):
+        """Answers for unique ``keys``, going to the provider only for misses."""
+        found = self.cache.get_many(self.provider_name, kind, keys)
+        missing = [k for k in keys if k not in found]
+        if cached_only or not missing or self.provider is None:
+            return found
+        with self._lock:
+            # Another thread or worker may have resolved some meanwhile.
+            found.update(self.cache.get_many(self.provider_name, kind, missing))
+            for key in missing:
+                if key in found:
+                    continue
+                if self.min_interval:
+                    time.sleep(self.cache.reserve(self.provider_name, self.min_interval))
+                    recheck = self.cache.get_many(self.provider_name, kind, [key])
+                    if key in recheck:
+                        found[key] = recheck[key]
+                        continue
+                try:
+                    place = fetch(key)
+                except GeocodingUnavailable as e:
+                    # Not cached: the next batch retries. Stop hammering now.
+                    log.warning('Geocoding provider unavailable, %d lookups deferred: %s',
+                                len([k for k in missing if k not in found]), e)
+                    break
+                self.cache.put(self.provider_name, kind, key, place,
+                               self.ttl if place is not None else self.miss_ttl)
+                found[key] = place
+        return found
+
+    def geocode_many(self, addresses, cached_only=False):
+        """{address: Place or None} for every non-empty address given."""
+        keys, originals = {}, {}
+        for address in addresses:
+            key = normalize_address(address)
+            if key:
+                keys[address] = key
+                originals.setdefault(key, ' '.join(address.split()))
+        # The normalized key only indexes the cache; the provider is queried
+        # with the first original spelling seen for that key.
+        found = self._resolve(ADDRESS, list(originals), lambda k: self.provider.geocode(originals[k]),
+                              cached_only)
+        return {a: found.get(k) for a, k in keys.items()}
+
+    def reverse_many(self, points, cached_only=False):
+        """{(lat, lng): Place or None} with a label for every point given."""
+        keys = {(lat, lng): point_key(lat, lng) for lat, lng in points}
+        unique = list(dict.fromkeys(keys.values()))
+
+        def fetch(key):
+            lat, lng = (float(x) for x in key.split(','))
+            return self.provider.reverse(lat, lng)
+
+        found = self._resolve(POINT, unique, fetch, cached_only)
+        return {p: found.get(k) for p, k in keys.items()}
+
+    def geocode(self, address, cached_only=False):
+        return self.geocode_many([address], cached_only).get(address)
+
+    def reverse(self, latitude, longitude, cached_only=False):
+        return self.reverse_many([(latitude, longitude)], cached_only).get((latitude, longitude))
+
+
+class Warmer:
+    """Background thread that resolves cache misses off the request path."""
+
+    def __init__(self, geocoder, batch_size=50):
+        self.geocoder = geocoder
+        self.batch_size = batch_size
+        self._addresses = {}
+        self._points = {}
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def submit(self, addresses=(), points=()):
+        if self.geocoder.provider is None:
+            return
+        with self._cond:
+            for address in addresses:
+                if address:
+                    self._addresses.setdefault(normalize_address(address), address)
+            for lat, lng in points:
+                self._points.setdefault(point_key(lat, lng), (lat, lng))
+            self._cond.notify()
+        self._ensure_started()
+
+    def _ensure_started(self):
+        """Start the thread once per process (gunicorn forks after import)."""
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='geocode-warmer', daemon=True).start()
+
+    def _take(self, pending):
+        batch = list(pending.values())[:self.batch_size]
+        for key in list(pending)[:self.batch_size]:
+            del pending[key]
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._addresses and not self._points:
+                    self._cond.wait()
+                addresses = self._take(self._addresses)
+                points = self._take(self._points)
+            try:
+                if addresses:
+                    self.geocoder.geocode_many(addresses)
+                if points:
+                    self.geocoder.reverse_many(points)
+            except Exception:
+                log.exception('Geocode warm-up failed')
+
+
+def make_provider(name=None):
+    """Provider named by GEOCODER; None when geocoding is off or unavailable."""
+    name = (name or os.getenv('GEOCODER', 'off')).lower()
+    if name == 'off':
+        return None
+    if name == 'stub':
+        return StubProvider()
+    if name == 'nominatim':
+        try:
+            return NominatimProvider(
+                user_agent=os.getenv('GEOCODER_USER_AGENT', 'arafat-app'),
+                domain=os.getenv('GEOCODER_DOMAIN') or None,
+                language=os.getenv('GEOCODER_LANGUAGE', 'ar'),
+                country_codes=os.getenv('GEOCODER_COUNTRY_CODES', 'sa') or None,
+            )
+        except RuntimeError as e:
+            log.warning('Geocoding disabled: %s', e)
+            return None
+    raise ValueError(f'unknown GEOCODER {name!r} (expected nominatim, stub or off)')
+
+
+def from_env(instance_path):
+    """Geocoder configured from the environment, caching under ``instance_path``."""
+    path = os.getenv('GEOCODE_CACHE_PATH', os.path.join(instance_path, 'geocode_cache.db'))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    min_interval = os.getenv('GEOCODE_MIN_INTERVAL')
+    return Geocoder(
+        make_provider(),
+        GeocodeCache(path),
+        ttl=float(os.getenv('GEOCODE_TTL_DAYS', 90)) * 86400,
+        miss_ttl=float(os.getenv('GEOCODE_MISS_TTL_HOURS', 24)) * 3600,
+        min_interval=float(min_interval) if min_interval else None,
+    )
@@ -0,0 +1,51 @@
+# gunicorn.conf.py
+# Loaded automatically by gunicorn from the working directory (both Procfile
+# entries). Sets up the shared directory that lets /metrics aggregate
+# Prometheus metrics across worker processes.
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+from gunicorn.config import Config
+
+
+def _wsgi_app_name():
+    # The APP_MODULE from the command line ("app:app", "relay:app"). Parsed
+    # here because hooks run too late: the directory must be set before
+    # prometheus_client is imported below.
+    args, _ = Config().parser().parse_known_args(sys.argv[1:])
+    return re.sub(r"[^\w.-]", "-", args.args[0] if args.args else "app")
+
+
+# One directory per app: on_starting empties it, and a scrape merges every
+# file in it, so app:app and relay:app on one host must not share it.
+multiproc_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR",
+    os.path.join(tempfile.gettempdir(), "arafat-prometheus-" + _wsgi_app_name()))
+os.makedirs(multiproc_dir, exist_ok=True)
+
+# Imported here, once the directory is set: importing it lazily inside
+# child_exit (gunicorn's SIGCHLD handler) re-enters the import when several
+# workers exit together and fails on the partially initialized module.
+from prometheus_client import multiprocess  # noqa: E402
+
+
+def on_starting(server):
+    # Start each deployment from empty counters
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # relay.py in async mode: start delivery threads as soon as the worker has
+    # loaded the app (after fork), not on its first request.
+    import sys
+    relay = sys.modules.get("relay")
+    if relay is not None:
+        relay.start_queue_workers()
@@ -0,0 +1,335 @@
+"""
+matching.py
+Spatial pairing engine behind the admin "الأزواج المقترحين" list.
+
+User coordinates are held in a compact float64 NumPy array and bucketed into a
+uniform lat/lng grid. Radius and nearest-neighbour queries only look at the
+cells around a point, and every distance is a vectorized haversine, so pairing
+n users costs roughly O(n * k) instead of the O(n^2) all-pairs geopy scan.
+
+Pairing is greedy by distance: the closest two unpaired users within
+``max_km`` are paired first, then the next closest, and so on. Ties are broken
+by input order, so callers that need a stable result should pass users
+ordered by id.
+"""
+import math
+import os
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEG_LAT = math.pi * EARTH_RADIUS_KM / 180.0
+
+# Default pairing radius, overridable from the environment.
+DEFAULT_MAX_KM = float(os.getenv('PAIRING_MAX_KM', '3'))
+
+# Neighbours kept per user while pairing. Lists are refreshed whenever they run
+# out of unpaired candidates, so this only trades memory for rounds.
+DEFAULT_NEIGHBOURS = 2
+
+# Grid cells hold roughly this many users; never narrower than MIN_CELL_KM.
+TARGET_PER_CELL = 1.5
+MIN_CELL_KM = 0.05
+
+# Cell keys are iy * _STRIDE + ix; 2**21 comfortably covers every ix at
+# MIN_CELL_KM, including negative longitudes and search offsets.
+_STRIDE = 1 << 21
+
+# Upper bound on candidate pairs materialised at once.
+_CHUNK_PAIRS = 4_000_000
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km; accepts scalars or broadcastable arrays."""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = np.radians(lon2) - np.radians(lon1)
+    a = np.sin(dphi / 2.0) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlmb / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class _Grid:
+    """Uniform lat/lng bucketing of a subset of points, sorted by cell key."""
+
+    def __init__(self, coords, members, cell_km):
+        self.cell_km = cell_km
+        max_abs_lat = float(np.abs(coords[:, 0]).max()) if len(coords) else 0.0
+        # Size longitude steps at the most poleward point so that every cell is
+        # at least cell_km wide for every point that may be queried.
+        cos_lat = max(math.cos(math.radians(min(max_abs_lat, 89.0))), 1e-3)
+        self.lat_step = cell_km / KM_PER_DEG_LAT
+        self.lon_step = cell_km / (KM_PER_DEG_LAT * cos_lat)
+
+        iy, ix = self.cells(coords[members, 0], coords[members, 1])
+        keys = iy * _STRIDE + ix
+        order = np.argsort(keys, kind='stable')
+        self.members = members[order]
+        self.keys, self.starts, self.counts = np.unique(
+            keys[order], return_index=True, return_counts=True)
+
+    def cells(self, lat, lon):
+        iy = np.floor(np.asarray(lat) / self.lat_step).astype(np.int64)
+        ix = np.floor(np.asarray(lon) / self.lon_step).astype(np.int64)
+        return iy, ix
+
+    def lookup(self, keys):
+        """Return (start, count) into ``members`` for each key; count 0 if absent."""
+        pos = np.searchsorted(self.keys, keys)
+        pos = np.minimum(pos, len(self.keys) - 1)
+        found = self.keys[pos] == keys
+        return self.starts[pos], np.where(found, self.counts[pos], 0)
+
+
+def _choose_cell_km(coords, members, max_km):
+    """Pick a cell size giving ~TARGET_PER_CELL points per cell, capped at max_km."""
+    if len(members) < 2:
+        return max(max_km, MIN_CELL_KM)
+    lat = coords[members, 0]
+    lon = coords[members, 1]
+    mid = math.radians(float(lat.mean()))
+    h = (float(lat.max()) - float(lat.min())) * KM_PER_DEG_LAT
+    w = (float(lon.max()) - float(lon.min())) * KM_PER_DEG_LAT * math.cos(mid)
+    area = max(h, MIN_CELL_KM) * max(w, MIN_CELL_KM)
+    cell = math.sqrt(area * TARGET_PER_CELL / len(members))
+    return min(max(cell, MIN_CELL_KM), max(max_km, MIN_CELL_KM))
+
+
+def _ring_offsets(radius):
+    r = np.arange(-radius, radius + 1)
+    dy, dx = np.meshgrid(r, r, indexing='ij')
+    return dy.ravel(), dx.ravel()
+
+
+def _pair_km(index, a, b):
+    """Haversine between users a and b using the index's precomputed radians."""
+    dphi = index._phi[b] - index._phi[a]
+    dlmb = index._lmb[b] - index._lmb[a]
+    h = np.sin(dphi / 2.0) ** 2 + index._cos[a] * index._cos[b] * np.sin(dlmb / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def _gather(grid, index, queries, qy, qx, radius, max_km):
+    """Yield (position in queries, candidate, distance) batches for all points
+    within the (2*radius+1)^2 block of cells around each query and max_km."""
+    ody, odx = _ring_offsets(radius)
+    q_rep = np.repeat(np.arange(len(queries)), len(ody))
+    keys = (np.repeat(qy, len(ody)) + np.tile(ody, len(queries))) * _STRIDE \
+        + np.repeat(qx, len(odx)) + np.tile(odx, len(queries))
+    start, count = grid.lookup(keys)
+    keep = count > 0
+    q_rep, start, count = q_rep[keep], start[keep], count[keep]
+    if not len(count):
+        return
+
+    # Split the (query, cell) pairs so no batch expands past _CHUNK_PAIRS.
+    bounds = np.searchsorted(np.cumsum(count), np.arange(_CHUNK_PAIRS, int(count.sum()), _CHUNK_PAIRS))
+    for q_part, s_part, c_part in zip(np.split(q_rep, bounds), np.split(start, bounds), np.split(count, bounds)):
+        total = int(c_part.sum())
+        if not total:
+            continue
+        first = np.cumsum(c_part) - c_part
+        pos = np.repeat(s_part - first, c_part) + np.arange(total)
+        cand = grid.members[pos]
+        qpos = np.repeat(q_part, c_part)
+        q = queries[qpos]
+        d = _pair_km(index, q, cand)
+        ok = (cand != q) & (d <= max_km)
+        yield qpos[ok], cand[ok], d[ok]
+
+
+def _top_k(q, cand, d, k):
+    """Keep the k nearest candidates per query, ordered by (distance, index).
+
+    ``q`` must already be grouped (non-decreasing), which _gather guarantees.
+    Groups are small, so they are normally sorted row-wise in a padded matrix;
+    heavily skewed groups (many users on one spot) fall back to a flat sort.
+    """
+    if not len(q):
+        return q, cand, d
+    starts = np.flatnonzero(np.r_[True, q[1:] != q[:-1]])
+    sizes = np.diff(np.r_[starts, len(q)])
+    width = int(sizes.max())
+    if len(starts) * width > 4 * len(q):
+        order = np.lexsort((cand, d, q))
+        q, cand, d = q[order], cand[order], d[order]
+        keep = (np.arange(len(q)) - np.repeat(starts, sizes)) < k
+        return q[keep], cand[keep], d[keep]
+
+    row = np.repeat(np.arange(len(starts)), sizes)
+    col = np.arange(len(q)) - np.repeat(starts, sizes)
+    dist = np.full((len(starts), width), np.inf)
+    idx = np.full((len(starts), width), np.iinfo(np.int64).max)
+    dist[row, col] = d
+    idx[row, col] = cand
+    order = np.lexsort((idx, dist), axis=1)[:, :k]
+    dist = np.take_along_axis(dist, order, axis=1)
+    idx = np.take_along_axis(idx, order, axis=1)
+    keep = np.isfinite(dist)
+    return np.broadcast_to(q[starts][:, None], dist.shape)[keep], idx[keep], dist[keep]
+
+
+def _knn(index, queries, points, k, max_km):
+    """k nearest ``points`` for each of ``queries`` within max_km.
+
+    Returns (nbr, dist, complete): ``nbr``/``dist`` are (len(queries), k) with
+    -1/inf padding, and ``complete`` marks rows whose list holds every point
+    within max_km (fewer than k were found).
+    """
+    m = len(queries)
+    nbr = np.full((m, k), -1, dtype=np.int64)
+    dist = np.full((m, k), np.inf)
+    if not m or not len(points):
+        return nbr, dist, np.ones(m, dtype=bool)
+
+    coords = index.coords
+    grid = _Grid(coords, points, _choose_cell_km(coords, points, max_km))
+    qy, qx = grid.cells(coords[queries, 0], coords[queries, 1])
+    rows = np.arange(m)
+    radius = 1
+    while len(rows):
+        guaranteed = radius * grid.cell_km
+        parts = list(_gather(grid, index, queries[rows], qy[rows], qx[rows], radius, max_km))
+        if parts:
+            qpos, cand, d = (np.concatenate(p) for p in zip(*parts))
+        else:
+            qpos = cand = np.empty(0, dtype=np.int64)
+            d = np.empty(0)
+        qpos, cand, d = _top_k(qpos, cand, d, k)
+        q = rows[qpos]
+
+        found = np.bincount(q, minlength=m)[rows]
+        if len(q):
+            group_start = np.searchsorted(q, q)
+            nbr[q, np.arange(len(q)) - group_start] = cand
+            dist[q, np.arange(len(q)) - group_start] = d
+        if guaranteed >= max_km:
+            break
+        # A row is final once its k-th neighbour lies inside the searched radius.
+        done = (found >= k) & (dist[rows, k - 1] <= guaranteed)
+        rows = rows[~done]
+        nbr[rows] = -1
+        dist[rows] = np.inf
+        radius += 1
+
+    return nbr, dist, (nbr[:, k - 1] < 0)
+
+
+class UserIndex:
+    """Grid index over user coordinates for radius, k-NN and pairing queries."""
+
+    def __init__(self, latitudes, longitudes):
+        self.coords = np.column_stack([
+            np.asarray(latitudes, dtype=np.float64),
+            np.asarray(longitudes, dtype=np.float64),
+        ]).reshape(-1, 2)
+        self._phi = np.radians(self.coords[:, 0])
+        self._lmb = np.radians(self.coords[:, 1])
+        self._cos = np.cos(self._phi)
+        self._grids = {}
+
+    @classmethod
+    def from_users(cls, users):
+        users = list(users)
+        return cls([u.latitude for u in users], [u.longitude for u in users])
+
+    def __len__(self):
+        return len(self.coords)
+
+    def _grid(self, cell_km):
+        grid = self._grids.get(cell_km)
+        if grid is None:
+            grid = self._grids[cell_km] = _Grid(self.coords, np.arange(len(self)), cell_km)
+        return grid
+
+    def within(self, lat, lon, radius_km):
+        """Indices and distances of users within radius_km of a point, nearest first."""
+        if not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        grid = self._grid(max(radius_km, MIN_CELL_KM))
+        iy, ix = grid.cells(lat, lon)
+        ody, odx = _ring_offsets(1)
+        start, count = grid.lookup((iy + ody) * _STRIDE + ix + odx)
+        idx = np.concatenate([grid.members[s:s + c] for s, c in zip(start, count)])
+        d = haversine_km(lat, lon, self.coords[idx, 0], self.coords[idx, 1])
+        keep = d <= radius_km
+        idx, d = idx[keep], d[keep]
+        order = np.lexsort((idx, d))
+        return idx[order], d[order]
+
+    def nearest(self, lat, lon, k=1, max_km=None):
+        """The k users closest to a point, optionally limited to max_km."""
+        if max_km is not None:
+            idx, d = self.within(lat, lon, max_km)
+            return idx[:k], d[:k]
+        d = haversine_km(lat, lon, self.coords[:, 0], self.coords[:, 1])
+        k = min(k, len(d))
+        idx = np.argpartition(d, k - 1)[:k] if k else np.empty(0, dtype=np.int64)
+        order = np.lexsort((idx, d[idx]))
+        return idx[order], d[idx][order]
+
+    def greedy_pairs(self, max_km=DEFAULT_MAX_KM, k=DEFAULT_NEIGHBOURS):
+        """Greedy closest-first pairing; returns (i, j, distance_km) arrays.
+
+        Runs as rounds of mutual-nearest matching: two unpaired users that are
+        each other's nearest unpaired neighbour are always paired by the
+        closest-first rule, so pairing them and repeating gives the same result
+        without ever sorting the full edge list. Neighbour lists that run out
+        of unpaired candidates are recomputed against the remaining users.
+        """
+        n = len(self)
+        free = np.ones(n, dtype=bool)
+        out_i, out_j, out_d = [], [], []
+
+        active = np.arange(n)
+        nbr, dist, complete = _knn(self, active, active, k, max_km)
+        while len(active):
+            live = (nbr >= 0) & free[np.maximum(nbr, 0)]
+            has = live.any(axis=1)
+            first = live.argmax(axis=1)
+            best = np.where(has, nbr[np.arange(len(active)), first], -1)
+            best_d = dist[np.arange(len(active)), first]
+
+            best_of = np.full(n, -1, dtype=np.int64)
+            best_of[active] = best
+            a = active[has]
+            b = best[has]
+            mutual = (best_of[b] == a) & (a < b)
+            if mutual.any():
+                a, b = a[mutual], b[mutual]
+                out_i.append(a)
+                out_j.append(b)
+                out_d.append(best_d[has][mutual])
+                free[a] = False
+                free[b] = False
+
+            # Exhausted lists that may be missing farther neighbours are
+            # refreshed against the users that are still unpaired.
+            stale = ~has & ~complete & free[active]
+            keep = free[active] & (has | stale)
+            if stale.any():
+                remaining = np.flatnonzero(free)
+                r_nbr, r_dist, r_complete = _knn(self, active[stale], remaining, k, max_km)
+                nbr[stale], dist[stale], complete[stale] = r_nbr, r_dist, r_complete
+            elif not mutual.any():
+                break
+            active, nbr, dist, complete = active[keep], nbr[keep], dist[keep], complete[keep]
+
+        if not out_i:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.empty(0)
+        i, j, d = np.concatenate(out_i), np.concatenate(out_j), np.concatenate(out_d)
+        order = np.lexsort((j, i, d))
+        return i[order], j[order], d[order]
+
+
+def compute_pairings(users, max_km=DEFAULT_MAX_KM):
+    """Build the admin pairings list as (name, phone, name, phone, distance_km)
+    tuples, closest pairs first."""
+    users = list(users)
+    index = UserIndex.from_users(users)
+    i, j, d = index.greedy_pairs(max_km)
+    return [
+        (users[a].name, users[a].phone, users[b].name, users[b].phone, km)
+        for a, b, km in zip(i.tolist(), j.tolist(), np.round(d, 2).tolist())
+    ]
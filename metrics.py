@@ -0,0 +1,211 @@
+"""
+metrics.py
+Prometheus metrics, slow-request logging and an opt-in sampling profiler
+shared by app.py and relay.py.
+
+Under gunicorn every worker is a separate process, so metrics are written to
+per-process files in PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py sets and
+cleans it) and /metrics merges all of them on each scrape. Without that
+variable, e.g. under `flask run`, the in-process registry is served instead.
+
+Environment:
+  PROMETHEUS_MULTIPROC_DIR  shared directory for worker metric files
+  SLOW_REQUEST_MS           log requests slower than this (default 1000)
+  DEBUG_TOKEN               enables POST /debug/profiler with X-Debug-Token
+  PROFILE_DIR               where sampled .prof files go (default /tmp/profiles)
+"""
+import cProfile
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+
+from flask import Response, g, jsonify, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest)
+from prometheus_client import multiprocess
+
+log = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 1000))
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN', '')
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/profiles')
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 15, 30)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Flask request latency by route.',
+    ['app', 'method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge(
+    'http_requests_in_flight', 'Requests currently being handled.',
+    ['app'], multiprocess_mode='livesum')
+UPSTREAM_LATENCY = Histogram(
+    'aisensy_request_duration_seconds', 'AiSensy HTTP call latency (per attempt).',
+    ['outcome'], buckets=LATENCY_BUCKETS)
+UPSTREAM_RESPONSES = Counter(
+    'aisensy_responses_total', 'AiSensy call results by HTTP status or error type.',
+    ['status'])
+UPSTREAM_IN_FLIGHT = Gauge(
+    'aisensy_requests_in_flight', 'AiSensy calls currently waiting on the upstream.',
+    multiprocess_mode='livesum')
+QUEUE_MESSAGES = Gauge(
+    'relay_queue_messages', 'Messages in the relay send queue by state.',
+    ['state'], multiprocess_mode='mostrecent')
+DB_QUERY_LATENCY = Histogram(
+    'db_query_duration_seconds', 'Database statement latency.',
+    ['app', 'operation'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+
+
+def statement_operation(statement):
+    """First SQL keyword (SELECT, INSERT, ...) as a low-cardinality label."""
+    match = re.match(r'\s*(\w+)', statement or '')
+    return match.group(1).upper() if match else 'OTHER'
+
+
+def instrument_engine(engine, app_name):
+    """Time every SQL statement executed through a SQLAlchemy engine."""
+    from sqlalchemy import event
+
+    # The start time lives on the per-statement execution context, so a
+    # statement that raises (and never reaches after_cursor_execute) leaves
+    # nothing behind on the pooled connection.
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _stop(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_query_start', None)
+        if started is None:
+            return
+        DB_QUERY_LATENCY.labels(app_name, statement_operation(statement)).observe(
+            time.perf_counter() - started)
+
+
+class _Profiler:
+    """Sampling profiler switched at runtime for every worker.
+
+    The switch lives in a small JSON file next to the metrics files, so one
+    POST reaches all gunicorn workers; each worker re-reads it at most once
+    per second.
+    """
+
+    def __init__(self):
+        directory = os.getenv('PROMETHEUS_MULTIPROC_DIR') or PROFILE_DIR
+        self.state_path = os.path.join(directory, 'profiler.json')
+        self._checked = 0.0
+        self._state = {'enabled': False, 'sample_rate': 0.0}
+        self._lock = threading.Lock()
+
+    def state(self):
+        now = time.monotonic()
+        if now - self._checked >= 1.0:
+            with self._lock:
+                self._checked = now
+                try:
+                    with open(self.state_path) as f:
+                        self._state = json.load(f)
+                except (OSError, ValueError):
+                    self._state = {'enabled': False, 'sample_rate': 0.0}
+        return self._state
+
+    def set_state(self, enabled, sample_rate):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'enabled': enabled, 'sample_rate': sample_rate}, f)
+        os.replace(tmp, self.state_path)
+        self._checked = 0.0
+
+    def should_sample(self):
+        state = self.state()
+        return state.get('enabled') and random.random() < state.get('sample_rate', 0.0)
+
+
+profiler = _Profiler()
+
+
+def metrics_response():
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app, app_name, collect=None):
+    """Instrument a Flask app and add /metrics and /debug/profiler.
+
+    ``collect`` is called before each scrape to refresh gauges that are
+    cheaper to read on demand (e.g. queue depth).
+    """
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.labels(app_name).inc()
+        if profiler.should_sample():
+            g._profile = cProfile.Profile()
+            g._profile.enable()
+
+    @app.teardown_request
+    def _observe(exc):
+        started = g.pop('_metrics_start', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        REQUESTS_IN_FLIGHT.labels(app_name).dec()
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        status = getattr(g, '_metrics_status', 500 if exc else 200)
+        REQUEST_LATENCY.labels(app_name, request.method, route, str(status)).observe(elapsed)
+
+        prof = g.pop('_profile', None)
+        if prof is not None:
+            prof.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            safe_route = re.sub(r'[^\w]+', '_', route).strip('_') or 'root'
+            path = os.path.join(PROFILE_DIR, f'{app_name}-{safe_route}-{int(time.time() * 1000)}-{os.getpid()}.prof')
+            prof.dump_stats(path)
+        if elapsed * 1000 >= SLOW_REQUEST_MS:
+            app.logger.warning('Slow request: %s %s -> %s in %.0f ms', request.method, request.path, status, elapsed * 1000)
+
+    @app.after_request
+    def _record_status(response):
+        g._metrics_status = response.status_code
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if collect is not None:
+            try:
+                collect()
+            except Exception:
+                log.exception('Metrics collection hook failed')
+        return metrics_response()
+
+    @app.route('/debug/profiler', methods=['GET', 'POST'])
+    def debug_profiler():
+        """
+        Toggle request sampling across all workers.
+        POST {"enabled": true, "sample_rate": 0.05} with header X-Debug-Token.
+        Profiles are written to PROFILE_DIR as .prof files (open with pstats/snakeviz).
+        """
+        if not DEBUG_TOKEN or request.headers.get('X-Debug-Token') != DEBUG_TOKEN:
+            return jsonify({"error": "not found"}), 404
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            try:
+                rate = float(data.get('sample_rate', 0.01))
+            except (AttributeError, TypeError, ValueError):
+                rate = math.nan
+            if not math.isfinite(rate):
+                return jsonify({"error": "sample_rate must be a number"}), 400
+            rate = min(max(rate, 0.0), 1.0)
+            profiler.set_state(bool(data.get('enabled')), rate)
+        return jsonify(dict(profiler.state(), profile_dir=PROFILE_DIR))
@@ -0,0 +1,91 @@
+"""
+migrate.py
+Bulk copy of the legacy SQLite files into the canonical ``user`` table.
+
+Three databases grew apart over time:
+  users.db            table ``users`` (AUTOINCREMENT ids)
+  instance/users.db   table ``user`` with ``matched_with``
+  instance/local.db   table ``user`` with a wider ``phone``
+Rows are streamed from each file in batches and inserted in one transaction
+per batch. Users are deduplicated by normalized phone number: rows already in
+the target win, then sources in the order given. Ids and ``matched_with`` are
+not carried over (they collide across files); rebuild pairings afterwards.
+"""
+import os
+import re
+import sqlite3
+
+from sqlalchemy import insert, select
+
+LEGACY_TABLES = ('user', 'users')
+COPIED_COLUMNS = ('name', 'phone', 'latitude', 'longitude', 'pickup', 'destination')
+
+
+def normalize_phone(phone):
+    return re.sub(r'[\s\-()]', '', str(phone or ''))
+
+
+def sqlite_path(engine):
+    """Absolute file path of a SQLite engine, or None for other databases."""
+    if engine.dialect.name != 'sqlite' or not engine.url.database:
+        return None
+    return os.path.realpath(engine.url.database)
+
+
+def _source_table(conn):
+    names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for name in LEGACY_TABLES:
+        if name in names:
+            return name
+    return None
+
+
+def migrate_sqlite_files(engine, table, sources, batch_size=1000, log=print):
+    """Copy users from legacy SQLite files into ``table``; returns per-file stats."""
+    target_path = sqlite_path(engine)
+    with engine.connect() as conn:
+        seen = {normalize_phone(p) for p in conn.execute(select(table.c.phone)).scalars()}
+
+    stats = {}
+    for path in sources:
+        if not os.path.exists(path):
+            log(f'{path}: not found, skipped')
+            continue
+        if target_path and os.path.realpath(path) == target_path:
+            log(f'{path}: is the target database, skipped')
+            continue
+
+        src = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            name = _source_table(src)
+            if name is None:
+                log(f'{path}: no user table, skipped')
+                continue
+            available = {row[1] for row in src.execute(f'PRAGMA table_info("{name}")')}
+            columns = [c for c in COPIED_COLUMNS if c in available]
+            cursor = src.execute(f'SELECT {", ".join(columns)} FROM "{name}" ORDER BY id')
+
+            copied = duplicates = 0
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                batch = []
+                for row in rows:
+                    record = dict(zip(columns, row))
+                    phone = normalize_phone(record['phone'])
+                    if not phone or phone in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(phone)
+                    record['phone'] = phone
+                    batch.append(record)
+                if batch:
+                    with engine.begin() as conn:
+                        conn.execute(insert(table), batch)
+                    copied += len(batch)
+            stats[path] = {'copied': copied, 'duplicates': duplicates}
+            log(f'{path}: copied {copied}, skipped {duplicates} duplicate phones')
+        finally:
+            src.close()
+    return stats
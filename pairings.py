@@ -0,0 +1,218 @@
+"""
+pairings.py
+Persisted pairing store for the admin suggested-pairs list.
+
+Pairs are kept in their own table (one row per pair, lower user id first) and
+mirrored into ``user.matched_with``, so the admin view reads them with a
+single query. Submissions and deletions only re-seat the users they affect:
+
+The closest-first pairing computed by matching.py is the unique *stable*
+pairing for these distances: no two users are both closer to each other than
+to their current partners. Adding, moving or removing a user frees at most one
+user at a time; that user takes the closest neighbour who prefers them over
+their current partner, which may free that partner in turn. The chain stops as
+soon as nobody is displaced, and only users within ``max_km`` are read.
+"""
+import math
+
+import numpy as np
+from sqlalchemy import bindparam, delete, insert, or_, select, update
+from sqlalchemy.orm import aliased
+
+import matching
+
+# Safety valve: a re-seating chain longer than this falls back to a rebuild.
+MAX_CHAIN = 10_000
+
+
+def _edge_key(distance, a, b):
+    """Total order used to break distance ties, matching matching.py."""
+    return (distance, min(a, b), max(a, b))
+
+
+class PairingStore:
+    def __init__(self, db, user_model, pairing_model, max_km=matching.DEFAULT_MAX_KM):
+        self.db = db
+        self.User = user_model
+        self.Pairing = pairing_model
+        self.max_km = max_km
+
+    # --- Reads ---
+    def pairings(self):
+        """Admin tuples (name, phone, name, phone, distance_km), closest first."""
+        User, Pairing = self.User, self.Pairing
+        a = aliased(User)
+        b = aliased(User)
+        rows = self.db.session.execute(
+            select(a.name, a.phone, b.name, b.phone, Pairing.distance_km)
+            .join(a, a.id == Pairing.user_id)
+            .join(b, b.id == Pairing.partner_id)
+            .order_by(Pairing.distance_km, Pairing.user_id, Pairing.partner_id)
+        )
+        return [(n1, p1, n2, p2, round(km, 2)) for n1, p1, n2, p2, km in rows]
+
+    def _pairs_of(self, user_ids):
+        """Map each paired id in user_ids to (partner_id, distance_km)."""
+        Pairing = self.Pairing
+        rows = self.db.session.execute(
+            select(Pairing.user_id, Pairing.partner_id, Pairing.distance_km).where(
+                or_(Pairing.user_id.in_(user_ids), Pairing.partner_id.in_(user_ids)))
+        ).all()
+        found = {}
+        for a, b, km in rows:
+            found[a] = (b, km)
+            found[b] = (a, km)
+        return found
+
+    def _neighbours(self, user):
+        """Users within max_km of ``user`` as (id, distance_km), nearest first."""
+        User = self.User
+        dlat = self.max_km / matching.KM_PER_DEG_LAT
+        top = min(abs(user.latitude) + dlat, 89.0)
+        dlon = self.max_km / (matching.KM_PER_DEG_LAT * math.cos(math.radians(top)))
+        rows = self.db.session.execute(
+            select(User.id, User.latitude, User.longitude).where(
+                User.id != user.id,
+                User.latitude.between(user.latitude - dlat, user.latitude + dlat),
+                User.longitude.between(user.longitude - dlon, user.longitude + dlon),
+            )
+        ).all()
+        if not rows:
+            return []
+        ids = np.array([r[0] for r in rows], dtype=np.int64)
+        d = matching.haversine_km(
+            user.latitude, user.longitude,
+            np.array([r[1] for r in rows]), np.array([r[2] for r in rows]))
+        keep = d <= self.max_km
+        ids, d = ids[keep], d[keep]
+        order = np.lexsort((ids, d))
+        return list(zip(ids[order].tolist(), d[order].tolist()))
+
+    # --- Writes ---
+    def _unpair(self, user_id):
+        """Drop the pair containing user_id; return the freed partner id."""
+        partner = self._pairs_of([user_id]).get(user_id, (None, None))[0]
+        if partner is None:
+            return None
+        Pairing, User = self.Pairing, self.User
+        self.db.session.execute(delete(Pairing).where(
+            or_(Pairing.user_id == user_id, Pairing.partner_id == user_id)))
+        self.db.session.execute(update(User).where(
+            User.id.in_([user_id, partner])).values(matched_with=None))
+        return partner
+
+    def _pair(self, a, b, distance):
+        lo, hi = min(a, b), max(a, b)
+        self.db.session.add(self.Pairing(user_id=lo, partner_id=hi, distance_km=distance))
+        User = self.User
+        self.db.session.execute(update(User).where(User.id == lo).values(matched_with=str(hi)))
+        self.db.session.execute(update(User).where(User.id == hi).values(matched_with=str(lo)))
+
+    def _seat(self, queue):
+        """Re-seat freed users until nobody is displaced."""
+        steps = 0
+        while queue:
+            steps += 1
+            if steps > MAX_CHAIN:
+                self.rebuild()
+                return
+            user = self.db.session.get(self.User, queue.pop())
+            if user is None:
+                continue
+            neighbours = self._neighbours(user)
+            paired = self._pairs_of([user.id] + [other for other, _ in neighbours])
+            # A queued user may have been taken meanwhile; only move for
+            # someone strictly better than the current partner.
+            mine, mine_km = paired.get(user.id, (None, math.inf))
+            limit = _edge_key(mine_km, user.id, mine if mine is not None else user.id)
+            for other, d in neighbours:
+                if _edge_key(d, user.id, other) >= limit:
+                    break
+                partner, current = paired.get(other, (None, math.inf))
+                if partner is not None and _edge_key(d, user.id, other) >= _edge_key(current, other, partner):
+                    continue
+                for freed in (self._unpair(user.id), self._unpair(other)):
+                    if freed is not None:
+                        queue.append(freed)
+                self._pair(user.id, other, d)
+                break
+            self.db.session.flush()
+
+    def add(self, user):
+        """Update pairs after ``user`` was inserted or moved (must be flushed)."""
+        self.db.session.flush()
+        freed = self._unpair(user.id)
+        queue = [user.id] if freed is None else [freed, user.id]
+        self._seat(queue)
+
+    def remove(self, user):
+        """Delete ``user`` and re-seat their former partner."""
+        freed = self._unpair(user.id)
+        self.db.session.delete(user)
+        self.db.session.flush()
+        if freed is not None:
+            self._seat([freed])
+
+    # --- Recovery ---
+    def compute(self):
+        """From-scratch pairing as {(lo_id, hi_id): distance_km}."""
+        User = self.User
+        rows = self.db.session.execute(
+            select(User.id, User.latitude, User.longitude).order_by(User.id)
+        ).all()
+        ids = [r[0] for r in rows]
+        index = matching.UserIndex([r[1] for r in rows], [r[2] for r in rows])
+        i, j, d = index.greedy_pairs(self.max_km)
+        return {(ids[a], ids[b]): km for a, b, km in zip(i.tolist(), j.tolist(), d.tolist())}
+
+    def rebuild(self):
+        """Replace every stored pair with a from-scratch computation."""
+        Pairing, User = self.Pairing, self.User
+        expected = self.compute()
+        self.db.session.execute(delete(Pairing))
+        self.db.session.execute(update(User).values(matched_with=None))
+        if expected:
+            self.db.session.execute(insert(Pairing), [
+                {'user_id': a, 'partner_id': b, 'distance_km': km}
+                for (a, b), km in expected.items()
+            ])
+            mirror = [{'uid': a, 'partner': str(b)} for (a, b) in expected]
+            mirror += [{'uid': b, 'partner': str(a)} for (a, b) in expected]
+            self.db.session.execute(
+                update(User.__table__)
+                .where(User.__table__.c.id == bindparam('uid'))
+                .values(matched_with=bindparam('partner')),
+                mirror,
+            )
+        return len(expected)
+
+    def check(self):
+        """Compare stored pairs with a from-scratch computation.
+
+        Returns a list of human-readable differences; empty means consistent.
+        """
+        Pairing, User = self.Pairing, self.User
+        stored = {
+            (r.user_id, r.partner_id): r.distance_km
+            for r in self.db.session.execute(select(Pairing)).scalars()
+        }
+        expected = self.compute()
+        problems = []
+        for key in sorted(expected.keys() - stored.keys()):
+            problems.append(f'missing pair {key[0]}-{key[1]} ({expected[key]:.3f} km)')
+        for key in sorted(stored.keys() - expected.keys()):
+            problems.append(f'unexpected pair {key[0]}-{key[1]} ({stored[key]:.3f} km)')
+        for key in sorted(stored.keys() & expected.keys()):
+            if not math.isclose(stored[key], expected[key], abs_tol=1e-9):
+                problems.append(f'distance drift for {key[0]}-{key[1]}: '
+                                f'{stored[key]:.6f} != {expected[key]:.6f} km')
+
+        partners = {}
+        for a, b in stored:
+            partners[a], partners[b] = str(b), str(a)
+        rows = self.db.session.execute(select(User.id, User.matched_with)).all()
+        for uid, matched_with in rows:
+            if partners.get(uid) != matched_with:
+                problems.append(f'user {uid} matched_with={matched_with!r}, '
+                                f'expected {partners.get(uid)!r}')
+        return problems
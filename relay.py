@@ -1,10 +1,16 @@
 # relay.py
 import os
 import logging
-from flask import Flask, request, jsonify, abort
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify, abort, url_for
 import requests
 from urllib.parse import urljoin
 
+import metrics
+from aisensy_client import AiSensyClient, is_unsent
+from send_queue import SendQueue, QueueWorkers
+
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
@@ -12,9 +18,25 @@ logging.basicConfig(level=logging.INFO)
 AISENSY_API_KEY = os.getenv("AISENSY_API_KEY", "")
 AISENSY_API_URL = os.getenv("AISENSY_API_URL", "https://api.aisensy.com/v1/message")
 
+# Pooled keep-alive client with rate limiting, retries and a circuit breaker
+aisensy = AiSensyClient(api_url=AISENSY_API_URL, api_key=AISENSY_API_KEY)
+
 # Optional simple auth token for the relay endpoint
 RELAY_SECRET = os.getenv("RELAY_SECRET", "")  # set to a random string in Render env
 
+# Async mode: /relay queues messages durably and returns 202; background
+# threads in each worker deliver them with retry and backoff.
+RELAY_ASYNC = os.getenv("RELAY_ASYNC", "").lower() in ("1", "true", "yes")
+RELAY_QUEUE_PATH = os.getenv("RELAY_QUEUE_PATH", os.path.join(app.instance_path, "relay_queue.db"))
+RELAY_QUEUE_WORKERS = int(os.getenv("RELAY_QUEUE_WORKERS", 4))
+RELAY_MAX_ATTEMPTS = int(os.getenv("RELAY_MAX_ATTEMPTS", 5))
+
+# /relay/batch limits
+RELAY_BATCH_MAX = int(os.getenv("RELAY_BATCH_MAX", 100))
+RELAY_BATCH_CONCURRENCY = int(os.getenv("RELAY_BATCH_CONCURRENCY", 8))
+# Budget for a whole synchronous batch, kept under gunicorn's 30s timeout
+RELAY_BATCH_TIMEOUT = float(os.getenv("RELAY_BATCH_TIMEOUT", 20))
+
 if not AISENSY_API_KEY:
     app.logger.warning("AISENSY_API_KEY not set. Relay will not send messages until it's configured.")
 
@@ -25,58 +47,171 @@ def home():
         "and header X-Relay-Auth: <RELAY_SECRET> (if set)."
     )
 
-def forward_to_aisensy(payload: dict) -> (int, str):
-    headers = {
-        "Authorization": f"Bearer {AISENSY_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    try:
-        resp = requests.post(AISENSY_API_URL, json=payload, headers=headers, timeout=15)
-        return resp.status_code, resp.text
-    except requests.RequestException as e:
-        app.logger.exception("Error sending to AiSensy")
-        return 503, str(e)
-
-@app.route("/relay", methods=["POST"])
-def relay():
+def check_relay_auth():
     # Optional: validate secret header
     if RELAY_SECRET:
         secret = request.headers.get("X-Relay-Auth", "")
         if secret != RELAY_SECRET:
             abort(401, description="Unauthorized: invalid relay secret")
 
-    data = request.get_json(silent=True)
-    if not data:
-        return jsonify({"error": "invalid json"}), 400
+def forward_to_aisensy(payload: dict, timeout: float = 15) -> (int, str):
+    # 503: the message was not sent. 504: the outcome is unknown (e.g. read
+    # timeout), so the send queue must not resend it.
+    try:
+        resp = aisensy.send(payload, timeout=timeout)
+        return resp.status_code, resp.text
+    except requests.RequestException as e:
+        app.logger.exception("Error sending to AiSensy")
+        return (503 if is_unsent(e) else 504), str(e)
+
+send_queue = None
+queue_workers = None
+if RELAY_ASYNC:
+    os.makedirs(os.path.dirname(os.path.abspath(RELAY_QUEUE_PATH)), exist_ok=True)
+    send_queue = SendQueue(RELAY_QUEUE_PATH, max_attempts=RELAY_MAX_ATTEMPTS)
+    queue_workers = QueueWorkers(send_queue, forward_to_aisensy, threads=RELAY_QUEUE_WORKERS)
+
+def start_queue_workers():
+    """Start this process's delivery threads (idempotent, per PID).
+
+    gunicorn.conf.py calls this when a worker boots so a backlog left by a
+    restart drains without waiting for a request; the before_request hook
+    covers `flask run` and other servers.
+    """
+    if queue_workers is not None and RELAY_QUEUE_WORKERS > 0:
+        queue_workers.ensure_started()
+
+app.before_request(start_queue_workers)
+
+def validate_message(data):
+    """Return (payload, None) for a valid message or (None, error)."""
+    if not data or not isinstance(data, dict):
+        return None, "invalid json"
 
     # Basic validation: expect { to, type, text:{ body } } as AiSensy expects
     to = data.get("to")
     typ = data.get("type")
     text = data.get("text")
     if not to or not typ or not text or not isinstance(text, dict) or "body" not in text:
-        return jsonify({"error": "missing fields, expected to,type,text{body}"}), 400
+        return None, "missing fields, expected to,type,text{body}"
 
     # Optional: normalize phone number (basic)
     # AiSensy likely expects international format; ensure + prefix.
     if isinstance(to, str) and not to.startswith("+"):
         # If number starts with 0 and local (e.g. 05...), user must provide correct intl format.
         # We will not attempt unsafe guessing; just return an error.
-        return jsonify({"error": "phone must be in international format starting with +"}), 400
+        return None, "phone must be in international format starting with +"
+
+    return {"to": to, "type": typ, "text": text}, None
+
+def collect_queue_metrics():
+    if send_queue is not None:
+        for state, count in send_queue.counts().items():
+            metrics.QUEUE_MESSAGES.labels(state).set(count)
+
+# Request latency, /metrics and /debug/profiler
+metrics.init_app(app, "relay", collect=collect_queue_metrics)
 
-    payload = {"to": to, "type": typ, "text": text}
+@app.route("/relay", methods=["POST"])
+def relay():
+    check_relay_auth()
+
+    payload, error = validate_message(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+    to = payload["to"]
+
+    if send_queue is not None:
+        msg_id = send_queue.enqueue(payload)
+        queue_workers.notify()
+        app.logger.info("Queued for AiSensy: id=%s, to=%s", msg_id, to)
+        status_url = url_for("relay_status", msg_id=msg_id)
+        return jsonify({"id": msg_id, "status": "queued", "status_url": status_url}), 202, {"Location": status_url}
 
     # Forward to AiSensy
     status, body = forward_to_aisensy(payload)
     app.logger.info("Forwarded to AiSensy: status=%s, to=%s", status, to)
     return (body, status, {"Content-Type": "application/json"})
 
+@app.route("/relay/batch", methods=["POST"])
+def relay_batch():
+    """
+    Relays many messages in one request.
+    Body: {"messages": [{to, type, text:{body}}, ...]} (or a bare list).
+    Invalid entries are reported per index and never block the valid ones.
+    Synchronous batches share one RELAY_BATCH_TIMEOUT budget; messages not
+    started before it runs out are reported as "not_attempted" (safe to resend).
+    """
+    check_relay_auth()
+
+    data = request.get_json(silent=True)
+    messages = data.get("messages") if isinstance(data, dict) else data
+    if not isinstance(messages, list) or not messages:
+        return jsonify({"error": "expected a non-empty messages list"}), 400
+    if len(messages) > RELAY_BATCH_MAX:
+        return jsonify({"error": f"at most {RELAY_BATCH_MAX} messages per batch"}), 413
+
+    results = [None] * len(messages)
+    valid = []
+    for i, item in enumerate(messages):
+        payload, error = validate_message(item)
+        if error:
+            results[i] = {"index": i, "error": error}
+        else:
+            valid.append((i, payload))
+
+    if send_queue is not None:
+        ids = send_queue.enqueue_many([payload for _, payload in valid])
+        queue_workers.notify()
+        for (i, _), msg_id in zip(valid, ids):
+            results[i] = {"index": i, "id": msg_id, "status": "queued",
+                          "status_url": url_for("relay_status", msg_id=msg_id)}
+        app.logger.info("Queued batch for AiSensy: %s queued, %s rejected", len(valid), len(messages) - len(valid))
+        return jsonify({"results": results}), 202
+
+    deadline = time.monotonic() + RELAY_BATCH_TIMEOUT
+
+    def send(item):
+        i, payload = item
+        remaining = deadline - time.monotonic()
+        if remaining < 1:
+            return {"index": i, "status": "not_attempted", "error": "batch time budget exhausted"}
+        status, body = forward_to_aisensy(payload, timeout=min(15, remaining))
+        return {"index": i, "status_code": status, "response": body}
+
+    with ThreadPoolExecutor(max_workers=min(RELAY_BATCH_CONCURRENCY, max(len(valid), 1))) as pool:
+        for result in pool.map(send, valid):
+            results[result["index"]] = result
+    sent = sum(1 for r in results if 200 <= r.get("status_code", 0) < 300)
+    app.logger.info("Forwarded batch to AiSensy: %s/%s accepted", sent, len(messages))
+    return jsonify({"results": results}), 200 if sent == len(messages) else 207
+
+@app.route("/relay/status/<msg_id>")
+def relay_status(msg_id):
+    check_relay_auth()
+    if send_queue is None:
+        return jsonify({"error": "async relay is disabled"}), 404
+    info = send_queue.get(msg_id)
+    if info is None:
+        return jsonify({"error": "unknown message id"}), 404
+    return jsonify(info)
+
+@app.cli.command("run-queue-worker")
+def run_queue_worker():
+    """Drain the send queue in the foreground (for a dedicated worker process)."""
+    if send_queue is None:
+        raise SystemExit("Set RELAY_ASYNC=1 to use the send queue.")
+    queue_workers.run_forever()
+
 # Small debug endpoint (safe when protected by RELAY_SECRET)
 @app.route("/debug/health")
 def health():
     return jsonify({
         "relay": True,
         "aisensy_key_present": bool(AISENSY_API_KEY),
-        "aisensy_url": AISENSY_API_URL
+        "aisensy_url": AISENSY_API_URL,
+        "async": RELAY_ASYNC,
+        "queue_depth": send_queue.depth() if send_queue is not None else None,
     })
 
 if __name__ == "__main__":
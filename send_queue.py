@@ -0,0 +1,269 @@
+"""
+send_queue.py
+Durable outgoing-message queue for relay.py.
+
+Messages are written to a local SQLite file before /relay answers, so a slow
+or failing AiSensy upstream no longer holds a gunicorn worker. A small pool of
+background threads drains the queue, retrying with exponential backoff only
+the failures AiSensy cannot have acted on (429, 503, no connection). The file is shared by every worker process: claims
+happen inside an IMMEDIATE transaction and carry a lease, so a message taken
+by a worker that dies is picked up again once the lease expires.
+"""
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+QUEUED = "queued"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_until REAL,
+    last_status_code INTEGER,
+    last_error TEXT,
+    response TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_messages_ready ON messages (status, next_attempt_at);
+"""
+
+
+def is_retryable(status_code):
+    """Only throttling (429) and "not sent" (503) are resent.
+
+    Other 5xx, and the 504 relay.forward_to_aisensy reports for read
+    timeouts, may mean the message went out, so retrying could duplicate it.
+    """
+    return status_code in (429, 503)
+
+
+class SendQueue:
+    def __init__(self, path, max_attempts=5, base_delay=2.0, max_delay=300.0, lease_seconds=60.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease_seconds = lease_seconds
+        self._local = threading.local()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        # One connection per thread, and never reuse one inherited across fork.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _execute(self, conn, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return conn.execute(sql, params)
+        finally:
+            metrics.DB_QUERY_LATENCY.labels("relay", metrics.statement_operation(sql)).observe(
+                time.perf_counter() - started)
+
+    def enqueue(self, payload):
+        """Persist a payload and return its message id."""
+        msg_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            self._connect(),
+            "INSERT INTO messages (id, payload, status, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (msg_id, json.dumps(payload), QUEUED, now, now, now),
+        )
+        return msg_id
+
+    def enqueue_many(self, payloads):
+        """Persist several payloads in one transaction; returns their ids."""
+        now = time.time()
+        rows = [(uuid.uuid4().hex, json.dumps(p), QUEUED, now, now, now) for p in payloads]
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO messages (id, payload, status, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [row[0] for row in rows]
+
+    def claim(self):
+        """Lease the next due message; returns (id, payload, attempt) or None."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._execute(
+                conn,
+                "SELECT id, payload, attempts FROM messages "
+                "WHERE (status = ? AND next_attempt_at <= ?) OR (status = ? AND lease_until < ?) "
+                "ORDER BY next_attempt_at LIMIT 1",
+                (QUEUED, now, SENDING, now),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            self._execute(
+                conn,
+                "UPDATE messages SET status = ?, attempts = attempts + 1, lease_until = ?, updated_at = ? "
+                "WHERE id = ?",
+                (SENDING, now + self.lease_seconds, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row["id"], json.loads(row["payload"]), row["attempts"] + 1
+
+    def complete(self, msg_id, attempt, status_code, body):
+        """Record an upstream result, scheduling a retry when appropriate.
+
+        Only the holder of the current lease may record it: if the lease
+        expired and the message was claimed again (``attempts`` moved on),
+        nothing is written and None is returned.
+        """
+        now = time.time()
+        if 200 <= status_code < 300:
+            status, next_at = SENT, now
+        elif is_retryable(status_code) and attempt < self.max_attempts:
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+            status, next_at = QUEUED, now + delay * random.uniform(0.5, 1.0)
+        else:
+            status, next_at = FAILED, now
+        error = None if status == SENT else body
+        cursor = self._execute(
+            self._connect(),
+            "UPDATE messages SET status = ?, next_attempt_at = ?, lease_until = NULL, "
+            "last_status_code = ?, last_error = ?, response = ?, updated_at = ? "
+            "WHERE id = ? AND status = ? AND attempts = ?",
+            (status, next_at, status_code, error, body, now, msg_id, SENDING, attempt),
+        )
+        if cursor.rowcount == 0:
+            log.warning("Lease on message %s (attempt %s) was lost; result %s not recorded",
+                        msg_id, attempt, status_code)
+            return None
+        return status
+
+    def get(self, msg_id):
+        row = self._execute(
+            self._connect(),
+            "SELECT id, status, attempts, last_status_code, last_error, response, created_at, updated_at "
+            "FROM messages WHERE id = ?",
+            (msg_id,),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def depth(self):
+        """Number of messages waiting or in flight."""
+        return self._execute(
+            self._connect(),
+            "SELECT COUNT(*) FROM messages WHERE status IN (?, ?)", (QUEUED, SENDING)
+        ).fetchone()[0]
+
+    def counts(self):
+        """Message count per status."""
+        rows = self._execute(self._connect(), "SELECT status, COUNT(*) FROM messages GROUP BY status")
+        found = dict(rows.fetchall())
+        return {status: found.get(status, 0) for status in (QUEUED, SENDING, SENT, FAILED)}
+
+
+class QueueWorkers:
+    """Background threads that drain a SendQueue through ``send(payload)``.
+
+    ``send`` must return (status_code, body) like relay.forward_to_aisensy.
+    """
+
+    def __init__(self, queue, send, threads=4, poll_interval=1.0):
+        self.queue = queue
+        self.send = send
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._pool = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """Start the pool once per process (gunicorn forks after import)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._pool = [
+                threading.Thread(target=self._run, name=f"send-queue-{i}", daemon=True)
+                for i in range(self.threads)
+            ]
+            for t in self._pool:
+                t.start()
+
+    def notify(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def run_forever(self):
+        """Start the pool and block until interrupted."""
+        self.ensure_started()
+        try:
+            while not self._stop.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim()
+            except sqlite3.Error:
+                log.exception("Could not claim from send queue")
+                job = None
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            msg_id, payload, attempt = job
+            try:
+                status_code, body = self.send(payload)
+            except Exception as e:
+                log.exception("Send failed for queued message %s", msg_id)
+                status_code, body = 500, str(e)
+            try:
+                state = self.queue.complete(msg_id, attempt, status_code, body)
+            except sqlite3.Error:
+                # The lease expires and the message is claimed again.
+                log.exception("Could not record result for queued message %s", msg_id)
+                continue
+            log.info("Queued message %s attempt %s: status=%s -> %s", msg_id, attempt, status_code, state)
@@ -5,39 +5,182 @@ Usage:
   export AISENSY_API_KEY='your_key'
   export AISENSY_API_URL='https://api.aisensy.com/v1/message'
   python3 send_test_whatsapp.py '+971501234567' 'Test message'
+
+Bulk mode streams recipients from a CSV (columns to/phone and message/body) or
+JSONL file ({"to": ..., "message": ...} per line), sends with bounded
+concurrency and records finished rows in a checkpoint file, so re-running the
+same command after an interruption resumes where it stopped:
+  python3 send_test_whatsapp.py --bulk campaign.csv --concurrency 8
+Only rows known not to have been sent are retried on resume. Rows whose
+outcome is unknown (read timeout, 5xx other than 503) are checkpointed and
+listed in <file>.unknown for manual follow-up instead of being sent twice.
 """
+import argparse
+import csv
+import json
 import os
 import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+from aisensy_client import get_client, is_unsent
+
 AISENSY_API_URL = os.getenv('AISENSY_API_URL', 'https://api.aisensy.com/v1/message')
 AISENSY_API_KEY = os.getenv('AISENSY_API_KEY')
 
 
+def read_messages(path):
+    """Yield (row_number, to, body) from a CSV or JSONL file, one row at a time."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith(('.jsonl', '.ndjson')):
+            for i, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    rec = json.loads(line)
+                    to = rec.get('to') or rec.get('phone')
+                    body = rec.get('message') or rec.get('body') or (rec.get('text') or {}).get('body')
+                except (ValueError, AttributeError):
+                    # Malformed or non-object line: reported as an invalid row.
+                    to = body = None
+                yield i, to, body
+        else:
+            for i, row in enumerate(csv.DictReader(f)):
+                yield i, row.get('to') or row.get('phone'), row.get('message') or row.get('body')
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding='utf-8') as f:
+        return {int(line) for line in f if line.strip()}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def bulk_main(argv):
+    parser = argparse.ArgumentParser(prog='send_test_whatsapp.py --bulk',
+                                     description='Send many WhatsApp messages from a CSV or JSONL file.')
+    parser.add_argument('file', help='CSV (to,message) or JSONL ({"to","message"}) file')
+    parser.add_argument('--concurrency', type=int, default=8, help='parallel sends (default 8)')
+    parser.add_argument('--checkpoint', help='checkpoint file (default <file>.checkpoint)')
+    parser.add_argument('--unknown', help='rows with an unknown outcome (default <file>.unknown)')
+    args = parser.parse_args(argv)
+
+    checkpoint_path = args.checkpoint or args.file + '.checkpoint'
+    unknown_path = args.unknown or args.file + '.unknown'
+    done = load_checkpoint(checkpoint_path)
+    if done:
+        print(f'Resuming: {len(done)} rows already finished per {checkpoint_path}')
+
+    # Keep one pooled connection per concurrent sender.
+    os.environ.setdefault('AISENSY_POOL_SIZE', str(args.concurrency))
+    client = get_client()
+
+    lock = threading.Lock()
+    in_flight = threading.BoundedSemaphore(args.concurrency * 2)
+    latencies = []
+    counts = {'sent': 0, 'failed': 0, 'unknown': 0, 'skipped': 0, 'invalid': 0}
+
+    def send_one(checkpoint, unknown, row, to, body):
+        # Runs in the pool and its future is never inspected: report every
+        # error here and always give the permit back, or the reader stalls.
+        try:
+            start = time.perf_counter()
+            status, error, unsent = None, None, False
+            try:
+                status = client.send_text(to, body, timeout=10).status_code
+            except requests.RequestException as e:
+                error, unsent = type(e).__name__, is_unsent(e)
+            except Exception as e:
+                print(f'Row {row}: unexpected error while sending', file=sys.stderr)
+                traceback.print_exc()
+                error = type(e).__name__
+            elapsed = time.perf_counter() - start
+            if status is not None and 200 <= status < 300:
+                outcome = 'sent'
+            elif status in (429, 503) or unsent:
+                outcome = 'retry'  # AiSensy did not act on it: resend on resume
+            elif status is not None and status < 500:
+                outcome = 'failed'  # a rejection AiSensy would repeat
+            else:
+                outcome = 'unknown'  # may have been sent: never resend blindly
+            with lock:
+                latencies.append(elapsed)
+                counts['failed' if outcome == 'retry' else outcome] += 1
+                if outcome != 'retry':
+                    checkpoint.write(f'{row}\n')
+                    checkpoint.flush()
+                if outcome == 'unknown':
+                    unknown.write(f'{row}\t{to}\t{status or error}\n')
+                    unknown.flush()
+        except Exception:
+            print(f'Row {row}: could not record the result', file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            in_flight.release()
+
+    interrupted = False
+    started = time.perf_counter()
+    with open(checkpoint_path, 'a', encoding='utf-8') as checkpoint, \
+            open(unknown_path, 'a', encoding='utf-8') as unknown, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        try:
+            for row, to, body in read_messages(args.file):
+                if row in done:
+                    counts['skipped'] += 1
+                    continue
+                if not to or not body:
+                    counts['invalid'] += 1
+                    continue
+                in_flight.acquire()
+                pool.submit(send_one, checkpoint, unknown, row, to, body)
+        except KeyboardInterrupt:
+            interrupted = True
+            print('Interrupted; waiting for in-flight sends (re-run to resume)...')
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    attempted = counts['sent'] + counts['failed'] + counts['unknown']
+    print(f"Sent: {counts['sent']}  Failed: {counts['failed']}  Unknown: {counts['unknown']}  "
+          f"Skipped (checkpoint): {counts['skipped']}  Invalid rows: {counts['invalid']}")
+    if counts['unknown']:
+        print(f'Rows that may or may not have been delivered: {unknown_path}')
+    print(f'Elapsed: {elapsed:.2f}s  Throughput: {attempted / elapsed if elapsed else 0:.1f} msg/s')
+    print('Latency ms: ' + '  '.join(
+        f'p{p}={percentile(latencies, p) * 1000:.0f}' for p in (50, 90, 95, 99)))
+    if interrupted:
+        sys.exit(130)
+    sys.exit(0 if counts['failed'] == 0 and counts['unknown'] == 0 else 1)
+
+
 def main():
     if not AISENSY_API_KEY:
         print('ERROR: AISENSY_API_KEY is not set in environment')
         sys.exit(2)
 
+    if len(sys.argv) > 1 and sys.argv[1] == '--bulk':
+        bulk_main(sys.argv[2:])
+
     if len(sys.argv) < 3:
         print('Usage: python3 send_test_whatsapp.py <PHONE_NUMBER> "Message text"')
+        print('       python3 send_test_whatsapp.py --bulk <FILE.csv|FILE.jsonl> [--concurrency N]')
         sys.exit(2)
 
     number = sys.argv[1]
     message = sys.argv[2]
 
-    headers = {
-        'Authorization': f'Bearer {AISENSY_API_KEY}',
-        'Content-Type': 'application/json'
-    }
-    data = {
-        'to': number,
-        'type': 'text',
-        'text': {'body': message}
-    }
-
     try:
-        resp = requests.post(AISENSY_API_URL, json=data, headers=headers, timeout=10)
+        resp = get_client().send_text(number, message, timeout=10)
         print('STATUS:', resp.status_code)
         print('BODY:', resp.text)
         if 200 <= resp.status_code < 300:
@@ -64,7 +207,8 @@ python3 send_test_whatsapp.py +971XXXXXXXXX "Test message"
 """
 import os
 import sys
-import requests
+
+from aisensy_client import get_client
 
 AISENSY_API_URL = os.getenv('AISENSY_API_URL', 'https://api.aisensy.com/v1/message')
 AISENSY_API_KEY = os.getenv('AISENSY_API_KEY')
@@ -80,18 +224,8 @@ if __name__ == '__main__':
     number = sys.argv[1]
     message = sys.argv[2]
 
-    headers = {
-        'Authorization': f'Bearer {AISENSY_API_KEY}',
-        'Content-Type': 'application/json'
-    }
-    payload = {
-        'to': number,
-        'type': 'text',
-        'text': {'body': message}
-    }
-
     try:
-        resp = requests.post(AISENSY_API_URL, json=payload, headers=headers, timeout=10)
+        resp = get_client().send_text(number, message, timeout=10)
         print('STATUS:', resp.status_code)
         print('BODY:', resp.text)
         if 200 <= resp.status_code < 300:
@@ -0,0 +1,113 @@
+import time
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+from aisensy_client import AiSensyClient, CircuitBreaker, CircuitOpenError, RateLimitTimeout
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ''
+
+
+def make_client(**kwargs):
+    options = dict(api_url='http://aisensy.invalid/v1/message', api_key='k', rate_per_sec=1000, burst=1000,
+                   max_retries=3, breaker=CircuitBreaker(threshold=0.5, min_calls=1, window=60, cooldown=0))
+    options.update(kwargs)
+    return AiSensyClient(**options)
+
+
+def open_breaker(client):
+    client.breaker.record(False)
+    assert client.breaker.state == CircuitBreaker.OPEN
+
+
+def test_rate_limit_timeout_does_not_hold_half_open_trial(monkeypatch):
+    client = make_client()
+    open_breaker(client)
+    client.limiter._tokens = 0
+    client.limiter.rate = 0.01
+    with pytest.raises(RateLimitTimeout):
+        client.send({}, timeout=0.05)
+
+    client.limiter._tokens = client.limiter.capacity
+    client.limiter.rate = 1000
+    monkeypatch.setattr(client, '_post', lambda payload, timeout: FakeResponse(200))
+    assert client.send({}, timeout=1).status_code == 200
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_unexpected_error_releases_half_open_trial(monkeypatch):
+    client = make_client()
+    open_breaker(client)
+
+    def boom(payload, timeout):
+        raise ValueError('unexpected')
+
+    monkeypatch.setattr(client, '_post', boom)
+    with pytest.raises(ValueError):
+        client.send({}, timeout=1)
+    assert client.breaker.state == CircuitBreaker.OPEN
+
+    monkeypatch.setattr(client, '_post', lambda payload, timeout: FakeResponse(200))
+    assert client.send({}, timeout=1).status_code == 200
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_open_breaker_rejects_until_cooldown():
+    client = make_client(breaker=CircuitBreaker(threshold=0.5, min_calls=1, window=60, cooldown=60))
+    open_breaker(client)
+    with pytest.raises(CircuitOpenError):
+        client.send({}, timeout=1)
+
+
+def test_retries_stop_at_overall_deadline(monkeypatch):
+    client = make_client(backoff_cap=2.0, breaker=CircuitBreaker(min_calls=100))
+    calls = []
+
+    def throttled(payload, timeout):
+        calls.append(timeout)
+        return FakeResponse(429, {'Retry-After': '1'})
+
+    monkeypatch.setattr(client, '_post', throttled)
+    started = time.monotonic()
+    resp = client.send({}, timeout=0.5)
+    assert resp.status_code == 429
+    assert time.monotonic() - started < 0.5
+    assert len(calls) == 1
+
+
+def test_connection_errors_retry_within_deadline(monkeypatch):
+    client = make_client(max_retries=100, backoff_base=0.05, backoff_cap=0.05, breaker=CircuitBreaker(min_calls=1000))
+    timeouts = []
+
+    def refused(payload, timeout):
+        timeouts.append(timeout)
+        reason = NewConnectionError(None, 'Connection refused')
+        raise requests.exceptions.ConnectionError(MaxRetryError(None, '/v1/message', reason))
+
+    monkeypatch.setattr(client, '_post', refused)
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.send({}, timeout=0.3)
+    assert time.monotonic() - started < 0.4
+    assert 1 < len(timeouts) < 100
+    assert all(t <= 0.3 for t in timeouts)
+
+
+def test_connection_dropped_after_send_is_not_retried(monkeypatch):
+    client = make_client(breaker=CircuitBreaker(min_calls=1000))
+    calls = []
+
+    def aborted(payload, timeout):
+        calls.append(timeout)
+        raise requests.exceptions.ConnectionError(ProtocolError('Connection aborted.'))
+
+    monkeypatch.setattr(client, '_post', aborted)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.send({}, timeout=1)
+    assert len(calls) == 1